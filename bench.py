@@ -0,0 +1,376 @@
+# Project: Text Formatter, task from Charles Wetherell book
+#
+# https://github.com/yevgab/text_formatter.git
+#
+# dr.doberman, EnesGUL, Faf_Faf, yevgab
+#
+"""
+bench measures formatting speed and memory on synthetic documents
+"""
+
+import argparse
+import sys
+import os
+import time
+import json
+import random
+import hashlib
+import platform
+import subprocess
+import tempfile
+import compileall
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import tf
+
+# 1 KB ... 1 GB
+DEFAULT_SIZES = "1K,10K,100K,1M,10M,100M,1G"
+SIZE_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+ALIGN_MODES = ("fill", "left", "right", "center", "optimal")
+
+# --startup: допустимое время import tf в микросекундах, число запусков
+# и документ из одной строки
+IMPORT_BUDGET_US = 5000
+STARTUP_RUNS = 20
+STARTUP_TEXT = "Hello, world\n"
+
+WORDS = (
+    "the of and to in that formatter page line text paragraph word "
+    "document footnote header number width height alignment output "
+    "и в не на что он с как это по но его она к у же вы за бы "
+    "страница строка абзац текст сноска колонтитул ширина высота "
+    "Тримбл Марта директор посмотрю пятнадцать ладонь молочник "
+    "consectetur adipiscing exceptionally internationalization a I"
+).split()
+
+# Подсистемы TextFormat и методы, время которых измеряется;
+# время вложенных вызовов входит во время внешних
+SUBSYSTEMS = {
+    "command":  "ProcessCommand",
+    "break":    "FormatLine",
+    "optimal":  "OptimalBreak",
+    "align":    "LineAlign",
+    "footnote": "FormatFNLine",
+    "header":   "HeaderForm",
+    "page":     "PageClose",
+    "output":   "PrintLine",
+}
+
+
+def parse_size(s):
+    """
+    Converts 10K, 5M, 1G or a number of bytes to bytes
+    """
+    s = s.strip().upper()
+    if s[-1:] in SIZE_UNITS:
+        return int(float(s[:-1]) * SIZE_UNITS[s[-1]])
+    return int(s)
+
+
+def make_corpus(size, par_words = 60, cmd_density = 0.05, w = 72,
+        align = "fill", seed = 0):
+    """
+    Generates a synthetic document of about size bytes
+
+    Yields input lines without line endings. Paragraph lengths vary around
+    par_words words; cmd_density is the share of paragraphs preceded by an
+    ?align, ?footnote, ?header or ?p_num command. align is the starting
+    alignment, "mixed" lets ?align commands switch between all modes.
+    """
+    rng = random.Random(seed)
+    total = 0
+
+    def emit(line):
+        nonlocal total
+        total += len(line.encode("UTF8")) + 1
+        return line
+
+    yield emit("?size 40, " + str(w))
+    yield emit("?align " + ("fill" if align == "mixed" else align))
+    yield emit("?header 3, 1, smart, top, Synthetic document")
+    while total < size:
+        if rng.random() < cmd_density:
+            kind = rng.randrange(3)
+            if kind == 0 and align == "mixed":
+                yield emit("?align " + rng.choice(ALIGN_MODES))
+            elif kind == 1:
+                yield emit("?header 3, 1, " + rng.choice(("left", "right", "center", "smart"))
+                    + ", " + rng.choice(("top", "bottom")) + ", Chapter " + str(rng.randrange(100)))
+            elif kind == 2:
+                yield emit("?p_num " + str(rng.randrange(1, 500)) + ", "
+                    + rng.choice(("arabic", "roman", "letter")) + ", p.")
+        n = max(1, int(rng.expovariate(1 / par_words)))
+        words = [rng.choice(WORDS) for i in range(n)]
+        # Строки абзаца разной длины, как в обычном тексте
+        i = 0
+        while i < n:
+            k = rng.randint(5, 14)
+            yield emit(" ".join(words[i:i + k]))
+            i += k
+            if rng.random() < cmd_density / 4:
+                lines = rng.randint(1, 3)
+                yield emit("?footnote " + str(lines))
+                for j in range(lines):
+                    yield emit(" ".join(rng.choice(WORDS) for x in range(rng.randint(3, 12))))
+        yield emit("")
+
+
+def corpus_file(corpus_dir, size, par_words, cmd_density, w, align, seed):
+    """
+    Returns the name of a generated corpus file, writing it if needed
+    """
+    key = "{}-{}-{}-{}-{}-{}".format(size, par_words, cmd_density, w, align, seed)
+    name = os.path.join(corpus_dir, "corpus-"
+        + hashlib.blake2b(key.encode(), digest_size = 8).hexdigest() + ".txt")
+    if not os.path.exists(name):
+        tmp = name + ".tmp"
+        with open(tmp, "w", encoding = "UTF8") as f:
+            for l in make_corpus(size, par_words, cmd_density, w, align, seed):
+                f.write(l)
+                f.write("\n")
+        os.replace(tmp, name)
+    return name
+
+
+def timed(method, times, key):
+    def wrapper(*args, **kw):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kw)
+        finally:
+            times[key] += time.perf_counter() - start
+    return wrapper
+
+
+def run_case(name, subsystems = False):
+    """
+    Formats a corpus file and returns its measurements
+
+    Runs in a fresh worker process, so peak_kb is the peak resident memory
+    of formatting this file only. With subsystems the methods listed in
+    SUBSYSTEMS are timed, which makes the run itself slower.
+    """
+    times = dict.fromkeys(SUBSYSTEMS, 0.0)
+    with open(name, encoding = "UTF8") as inf, \
+            open(os.devnull, "w", encoding = "UTF8") as outf:
+        t = tf.TextFormat(out = tf.PageWriter(outf, 1))
+        if subsystems:
+            for key, method in SUBSYSTEMS.items():
+                setattr(t, method, timed(getattr(t, method), times, key))
+        lines = 0
+        start = time.perf_counter()
+        for l in tf.read_lines(inf):
+            t.ProcessStripped(l)
+            lines += 1
+        t.Flush(True)
+        seconds = time.perf_counter() - start
+    result = {
+        "bytes": os.path.getsize(name),
+        "lines": lines,
+        "pages": t.out.pages,
+        "seconds": seconds,
+        "lines_per_sec": lines / seconds if seconds > 0 else None,
+        "pages_per_sec": t.out.pages / seconds if seconds > 0 else None,
+        "peak_kb": None,
+    }
+    if resource != None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS возвращает байты, Linux - килобайты
+        result["peak_kb"] = peak // 1024 if sys.platform == "darwin" else peak
+    if subsystems:
+        result["subsystems"] = times
+    return result
+
+
+def measure(name, subsystems = False):
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers = 1, mp_context = ctx) as pool:
+        return pool.submit(run_case, name, subsystems).result()
+
+
+def import_time(module = "tf"):
+    """
+    Measures import of a module with python -X importtime
+
+    Returns the cumulative time in microseconds and the names of the
+    modules it loaded.
+    """
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd = os.path.dirname(os.path.abspath(__file__)),
+        capture_output = True, text = True, check = True).stderr
+    rows = []
+    for l in err.splitlines():
+        fields = l.partition(":")[2].split("|")
+        if not l.startswith("import time:") or len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        rows.append((int(fields[1]), fields[2].rstrip()))
+    # Модули выводятся после всех модулей, которые они импортируют,
+    # вложенность обозначается отступом
+    end = next(i for i, (us, name) in enumerate(rows) if name == " " + module)
+    start = end
+    while start > 0 and rows[start - 1][1].startswith("   "):
+        start -= 1
+    return rows[end][0], [name.strip() for us, name in rows[start:end]]
+
+
+def cold_start(args, text = STARTUP_TEXT, runs = STARTUP_RUNS):
+    """
+    Returns the fastest and the median wall time of a command in seconds
+    """
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, input = text, capture_output = True, text = True, check = True,
+            cwd = os.path.dirname(os.path.abspath(__file__)))
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def startup(budget = IMPORT_BUDGET_US):
+    """
+    Measures import time of tf and formatting of a one-line document
+
+    Python itself is measured as well, tf_seconds is the time python -m
+    tf adds to the start of the interpreter. Bytecode is compiled first,
+    as it is after the first run; python tf.py compiles the script every
+    time and is measured separately.
+    """
+    compileall.compile_dir(os.path.dirname(os.path.abspath(__file__)), maxlevels = 0,
+        force = True, quiet = 1)
+    runs = [import_time() for i in range(5)]
+    import_us, modules = min(runs)
+    python_min, python_median = cold_start([sys.executable, "-c", "pass"])
+    tf_min, tf_median = cold_start([sys.executable, "-m", "tf"])
+    script_min, script_median = cold_start([sys.executable, "tf.py"])
+    return {
+        "import_us": import_us,
+        "import_budget_us": budget,
+        "modules": modules,
+        "python_seconds": python_min,
+        "cold_start_seconds": tf_min,
+        "cold_start_median": tf_median,
+        "script_seconds": script_min,
+        "tf_seconds": tf_min - python_min,
+    }
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """
+    Prints lines/sec of two result files side by side to stderr
+    """
+    if "startup" in old and "startup" in new:
+        print("import tf: {} us -> {} us, cold start: {:.1f} ms -> {:.1f} ms".format(
+            old["startup"]["import_us"], new["startup"]["import_us"],
+            old["startup"]["cold_start_seconds"] * 1000,
+            new["startup"]["cold_start_seconds"] * 1000), file = sys.stderr)
+    if len(new["results"]) == 0:
+        return
+    prev = {r["size"]: r for r in old["results"]}
+    print("{:>10} {:>14} {:>14} {:>8}".format("size", "old lines/s", "new lines/s", "ratio"),
+        file = sys.stderr)
+    for r in new["results"]:
+        o = prev.get(r["size"])
+        if o == None or not o["lines_per_sec"] or not r["lines_per_sec"]:
+            continue
+        print("{:>10} {:>14.0f} {:>14.0f} {:>8.2f}".format(r["size"],
+            o["lines_per_sec"], r["lines_per_sec"], r["lines_per_sec"] / o["lines_per_sec"]),
+            file = sys.stderr)
+
+
+def main():
+    """ Benchmark entry point """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default = DEFAULT_SIZES,
+        help = "Comma separated corpus sizes, e.g. 1K,1M,1G.")
+    parser.add_argument("--par_words", type = int, default = 60,
+        help = "Mean number of words in a paragraph.")
+    parser.add_argument("--cmd_density", type = float, default = 0.05,
+        help = "Share of paragraphs preceded by a command.")
+    parser.add_argument("--width", type = int, default = 72, help = "Page width.")
+    parser.add_argument("--align", choices = ALIGN_MODES + ("mixed",), default = "fill",
+        help = "Alignment mode, mixed switches modes with ?align commands.")
+    parser.add_argument("--seed", type = int, default = 0, help = "Corpus generator seed.")
+    parser.add_argument("--repeat", type = int, default = 1,
+        help = "Runs per size, the fastest one is reported.")
+    parser.add_argument("--subsystems", action = "store_true",
+        help = "Add a run with per subsystem timings.")
+    parser.add_argument("--corpus_dir", default = os.path.join(tempfile.gettempdir(), "tf_bench"),
+        help = "Directory for generated corpora, reused between runs.")
+    parser.add_argument("--startup", action = "store_true",
+        help = "Measure import time and start of tf.py on a one-line document instead.")
+    parser.add_argument("--import_budget", type = int, default = IMPORT_BUDGET_US,
+        help = "Import time of tf in microseconds --startup fails above.")
+    parser.add_argument("-o", help = "JSON file to write results to.")
+    parser.add_argument("--compare", metavar = "JSON",
+        help = "Results of a previous run to compare with.")
+    args = parser.parse_args()
+
+    os.makedirs(args.corpus_dir, exist_ok = True)
+    report = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {"par_words": args.par_words, "cmd_density": args.cmd_density,
+            "width": args.width, "align": args.align, "seed": args.seed},
+        "results": [],
+    }
+    over_budget = False
+    if args.startup:
+        st = report["startup"] = startup(args.import_budget)
+        over_budget = st["import_us"] > st["import_budget_us"]
+        print("import tf: {} us (budget {} us), {} modules; cold start {:.1f} ms, "
+            "tf.py {:.1f} ms, python alone {:.1f} ms".format(st["import_us"],
+            st["import_budget_us"], len(st["modules"]), st["cold_start_seconds"] * 1000,
+            st["script_seconds"] * 1000, st["python_seconds"] * 1000), file = sys.stderr)
+        if over_budget:
+            print("import tf is over budget, modules: " + ", ".join(st["modules"]),
+                file = sys.stderr)
+    for s in args.sizes.split(",") if not args.startup else []:
+        size = parse_size(s)
+        name = corpus_file(args.corpus_dir, size, args.par_words, args.cmd_density,
+            args.width, args.align, args.seed)
+        runs = [measure(name) for i in range(max(1, args.repeat))]
+        result = min(runs, key = lambda r: r["seconds"])
+        if args.subsystems:
+            result["subsystems"] = measure(name, True)["subsystems"]
+        result["size"] = s.strip()
+        report["results"].append(result)
+        print("{:>6}: {} lines, {} pages in {:.3f} s, {:.0f} lines/s, {:.1f} pages/s, peak {} KB".format(
+            result["size"], result["lines"], result["pages"], result["seconds"],
+            result["lines_per_sec"] or 0, result["pages_per_sec"] or 0, result["peak_kb"]),
+            file = sys.stderr)
+
+    if args.o != None:
+        with open(args.o, "w", encoding = "UTF8") as f:
+            json.dump(report, f, indent = 2)
+    else:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+
+    if args.compare != None:
+        with open(args.compare, encoding = "UTF8") as f:
+            compare(json.load(f), report)
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
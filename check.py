@@ -0,0 +1,292 @@
+# Project: Text Formatter, task from Charles Wetherell book
+#
+# https://github.com/yevgab/text_formatter.git
+#
+# dr.doberman, EnesGUL, Faf_Faf, yevgab
+#
+"""
+check compares every formatting path with sequential formatting
+"""
+
+import argparse
+import sys
+import os
+import io
+import hashlib
+import tempfile
+import threading
+
+import tf
+import bench
+
+# Образцы из репозитория
+SAMPLES = ("ms.txt", "me_and_my_shadow.txt")
+
+# sha256 вывода исходной построчной реализации для образцов, в которых
+# все ?align заменены одной командой в начале документа
+GOLDEN = {
+    ("ms.txt", "left"):
+        "e34db7be7984b12289a05d9b1c62e0f68ddc7dfb0581db3d3c0cb4e7a7ab6cf0",
+    ("ms.txt", "right"):
+        "fa11aabeda5d7bcae2a8db266500db646c6d2906ac40e401f77df5f386520c79",
+    ("ms.txt", "center"):
+        "dbc557ef85e522d0cb04f0c0a55a0867501c4a6f2d225a46565a2a7134d80198",
+    ("me_and_my_shadow.txt", "left"):
+        "b2e38d14ebd07c16d91e3e774a43a6890fe4559a3a91b8d4c82ee8631b38e190",
+    ("me_and_my_shadow.txt", "right"):
+        "897379204f10fea00f481bd2548a112b9e55794ff58d15dbaab2c44805ed6601",
+    ("me_and_my_shadow.txt", "center"):
+        "d67a20d6e66ac5a8cccb0ff3bd5eebc20339b8e4d3a3e2274826d13c45e5ffb1",
+}
+
+# Режимы, в которых каждый документ проверяется еще раз; для fill
+# исходного вывода нет, выравнивание по ширине с тех пор изменилось
+ALIGN_MODES = ("left", "right", "center", "fill")
+
+# Размеры страниц (h, w) для format_layouts
+LAYOUTS = ((40, 72), (30, 60), (25, 40))
+
+# Размер блоков, которыми читаются файлы и каналы в проверке stream: не
+# кратный длине строк, чтобы блоки делили CRLF и символы UTF-8
+STREAM_CHUNK = 1000
+
+# Небольшие документы: строки документа и пары (номер страницы, строка
+# вывода), которые должны быть на этой странице
+CASES = {
+    "footnote after a literal [1]": ([
+        "?size 20, 40",
+        "As noted in [1] the reference comes later.",
+        " ".join(["word"] * 300),
+        "The reference is here.",
+        "?footnote 1",
+        "Footnote text.",
+        "Second one.",
+        "?footnote 2",
+        "Another footnote",
+        "on two lines.",
+        "End of text.",
+    ], [
+        (2, "As noted in [1] the reference comes"),
+        (3, "reference is here.[1] Second one.[2]"),
+        (3, "[1] Footnote text."),
+        (3, "[2] Another footnote on two lines."),
+    ]),
+    "alias": ([
+        "?alias q, z",
+        "qqq aqa",
+        "?alias",
+        "qqq",
+        "",
+        "?alias _, ",
+        "one_two",
+        "?alias",
+        "three_four",
+    ], [
+        (1, "zzz aza qqq"),
+        (1, "one two three_four"),
+    ]),
+}
+
+
+def with_align(lines, align):
+    """
+    Returns lines with all ?align commands replaced by one at the start
+    """
+    return ["?align " + align] + [l for l in lines if not l.startswith("?align")]
+
+
+def sequential(lines, tf_class = tf.TextFormat, w = 72, h = 40):
+    """
+    Formats lines one by one, the output the other paths must match
+    """
+    buf = io.StringIO()
+    t = tf_class(w, h, out = tf.PageWriter(buf, 0))
+    for l in lines:
+        t.ProcessStripped(l)
+    t.Flush(True)
+    return buf.getvalue()
+
+
+def split_pages(text):
+    """
+    Cuts formatted text into pages, every page but the last ends with '\f'
+    """
+    parts = text.split("\f\n")
+    return [p + "\f\n" for p in parts[:-1]] + [parts[-1]]
+
+
+def check_compiled(lines, expected):
+    buf = io.StringIO()
+    t = tf.TextFormat(out = tf.PageWriter(buf, 0))
+    t.ProcessCompiled(tf.CompiledDocument.Compile(lines))
+    t.Flush(True)
+    return buf.getvalue() == expected
+
+
+def check_layouts(lines, expected):
+    bufs = [io.StringIO() for h, w in LAYOUTS]
+    tf.format_layouts(lines, [(h, w, tf.PageWriter(buf, 0))
+        for (h, w), buf in zip(LAYOUTS, bufs)])
+    for (h, w), buf in zip(LAYOUTS, bufs):
+        if buf.getvalue() != sequential(lines, tf.LayoutFormat, w, h):
+            return False
+    return True
+
+
+def check_pages(lines, expected):
+    pages = split_pages(expected)
+    n = len(pages)
+    with tempfile.TemporaryDirectory() as tmp:
+        name = os.path.join(tmp, "doc.txt")
+        with open(name, "w", encoding = "UTF8") as f:
+            f.write("\n".join(lines) + "\n")
+        index = tf.PageIndex.Build(name)
+        for first, last in ((1, 1), (1, n), (n, n), (n // 2 + 1, n // 2 + 3), (2, None)):
+            buf = io.StringIO()
+            index.Render(name, first, last, buf)
+            if buf.getvalue() != "".join(pages[first - 1:last]):
+                return False
+    return True
+
+
+def check_incremental(lines, expected):
+    inc = tf.IncrementalFormat()
+    if inc.Format(lines) != expected:
+        return False
+    # Правка в середине документа, затем удаление строки в начале и
+    # возврат к исходному тексту
+    k = len(lines) // 2
+    edited = lines[:k] + [lines[k] + " edited", "", "Inserted paragraph."] + lines[k + 1:]
+    for doc in (edited, edited[:1] + edited[2:], lines):
+        if inc.Format(doc) != sequential(doc):
+            return False
+    return True
+
+
+def check_iterpages(lines, expected):
+    pages = list(tf.TextFormat().IterPages(lines))
+    if "".join(page.Text() for page in pages) != expected:
+        return False
+    return tf.format_text("\n".join(lines) + "\n") == expected
+
+
+def check_stream(lines, expected):
+    # Строки кончаются по очереди LF, CRLF и CR; CR перед пустой строкой
+    # с LF дал бы CRLF, поэтому там остается CRLF
+    ends = ("\n", "\r\n", "\r")
+    text = ""
+    for i, l in enumerate(lines):
+        end = ends[i % 3]
+        if end == "\r" and i + 1 < len(lines) and lines[i + 1] == "":
+            end = "\r\n"
+        text += l + end
+    data = text.encode("UTF8")
+
+    chunk = tf.READ_CHUNK
+    tf.READ_CHUNK = STREAM_CHUNK
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            name = os.path.join(tmp, "doc.txt")
+            with open(name, "wb") as f:
+                f.write(data)
+            with open(name, encoding = "UTF8", newline = "") as f:
+                if sequential(tf.read_lines(f)) != expected:
+                    return False
+        if sequential(tf.read_lines(io.StringIO(text, newline = ""))) != expected:
+            return False
+
+        rfd, wfd = os.pipe()
+        def feed():
+            with open(wfd, "wb") as f:
+                for i in range(0, len(data), STREAM_CHUNK):
+                    f.write(data[i:i + STREAM_CHUNK])
+                    f.flush()
+        feeder = threading.Thread(target = feed)
+        feeder.start()
+        buf = io.StringIO()
+        with open(rfd, "rb", buffering = 0) as f:
+            tf.format_stream(f, tf.TextFormat(out = tf.StreamWriter(buf)))
+        feeder.join()
+        return buf.getvalue() == expected
+    finally:
+        tf.READ_CHUNK = chunk
+
+
+# Пути форматирования, которые должны давать вывод sequential
+CHECKS = {
+    "compiled":    check_compiled,
+    "layouts":     check_layouts,
+    "pages":       check_pages,
+    "incremental": check_incremental,
+    "iterpages":   check_iterpages,
+    "stream":      check_stream,
+}
+
+
+def check_case(name, lines, expected):
+    """
+    Checks that every expected line is on its page and there are no errors
+    """
+    text = sequential(lines)
+    pages = split_pages(text)
+    ok = ">>> ERROR" not in text
+    for page, line in expected:
+        ok = ok and page <= len(pages) and line in pages[page - 1]
+    print("{:<36} {:<11} {}".format(name, "case", "OK" if ok else "FAILED"), file = sys.stderr)
+    return not ok
+
+
+def check_document(name, lines):
+    """
+    Runs all CHECKS on a document, returns the number of failed ones
+    """
+    expected = sequential(lines)
+    failed = 0
+    for path, check in CHECKS.items():
+        ok = check(lines, expected)
+        if ok == None:
+            print("{:<36} {:<11} skipped".format(name, path), file = sys.stderr)
+            continue
+        print("{:<36} {:<11} {}".format(name, path, "OK" if ok else "FAILED"), file = sys.stderr)
+        failed += not ok
+    return failed
+
+
+def main():
+    """ Check entry point """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default = "256K",
+        help = "Size of the generated document, e.g. 64K, 1M.")
+    parser.add_argument("--seed", type = int, default = 0, help = "Corpus generator seed.")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    documents = []
+    for sample in SAMPLES:
+        with open(os.path.join(here, sample), encoding = "UTF8") as f:
+            documents.append((sample, list(tf.read_lines(f))))
+    documents.append(("generated " + args.size, list(bench.make_corpus(
+        bench.parse_size(args.size), align = "mixed", seed = args.seed))))
+
+    failed = 0
+    for name, (lines, expected) in CASES.items():
+        failed += check_case(name, lines, expected)
+        failed += check_document(name, lines)
+    for name, lines in documents:
+        failed += check_document(name, lines)
+        for align in ALIGN_MODES:
+            aligned = with_align(lines, align)
+            failed += check_document(name + " " + align, aligned)
+            golden = GOLDEN.get((name, align))
+            if golden != None:
+                ok = hashlib.sha256(sequential(aligned).encode("UTF8")).hexdigest() == golden
+                print("{:<36} {:<11} {}".format(name + " " + align, "golden",
+                    "OK" if ok else "FAILED"), file = sys.stderr)
+                failed += not ok
+
+    print("{} checks failed".format(failed), file = sys.stderr)
+    sys.exit(1 if failed > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,18 +8,39 @@
 tf is the main module that manages the application
 """
 
-import argparse
+# Здесь только модули, нужные для форматирования; остальные (argparse,
+# random, re, pickle, asyncio, пулы процессов и т.д.) импортируются там,
+# где используются, чтобы запуск на коротких текстах был быстрым
 import sys
-import codecs
-import re
-import random
-
-# fill|left|right|center|as_is
-A_FILL   = 0
-A_LEFT   = 1
-A_RIGHT  = 2
-A_CENTER = 3
-A_AS_IS  = 4
+import os
+import stat
+import mmap
+import time
+import io
+from itertools import accumulate, islice
+from collections import deque
+from tfwidth import is_narrow, text_width, ljust, rjust, center
+
+# fill|left|right|center|as_is|optimal
+A_FILL    = 0
+A_LEFT    = 1
+A_RIGHT   = 2
+A_CENTER  = 3
+A_AS_IS   = 4
+A_OPTIMAL = 5
+
+# ?align fill: which gaps get extra spaces
+FILL_LEFT      = 0
+FILL_RIGHT     = 1
+FILL_ALTERNATE = 2
+FILL_RANDOM    = 3
+
+FILL_POLICY = {
+    "left":      FILL_LEFT,
+    "right":     FILL_RIGHT,
+    "alternate": FILL_ALTERNATE,
+    "random":    FILL_RANDOM,
+}
 
 # left|right|center|smart, top|bottom
 H_LEFT   = 0
@@ -36,63 +57,492 @@ PNUM_ROMAN  = 1
 PNUM_LETTER = 2
 
 MIN_PAGE_SIZE = (20, 20) # h, w
+MAX_PAGE_SIZE = (10000, 1000) # h, w
+
+# read_lines: bytes of a mapped file decoded at once
+READ_CHUNK = 1 << 20
+
+# FormatServer: documents larger than SERVE_INLINE_LIMIT bytes are
+# formatted in worker processes, larger than SERVE_MAX_SIZE are rejected,
+# requests not received in SERVE_TIMEOUT seconds are dropped
+SERVE_INLINE_LIMIT = 64 * 1024
+SERVE_MAX_SIZE = 32 * 1024 * 1024
+SERVE_TIMEOUT = 30
+
+# ?align optimal considers only breaks that leave no more than
+# 1/OPT_TOLERANCE of the line empty
+OPT_TOLERANCE = 4
 
 FN_OFFSET = 5
 FN_INDENT = -FN_OFFSET
-
-RM_DIG = {
-    1:"I",
-    2:"II",
-    3:"III",
-    4:"IV",
-    5:"V",
-    6:"VI",
-    7:"VII",
-    8:"VIII",
-    9:"IX",
-    10:"X",
-    40:"XL",
-    50:"L",
-    90:"XC",
-    100:"C",
-    400:"CD",
-    500:"D",
-    900:"CM",
-    1000:"M"
+# Ссылка на сноску в абзаце начинается с FN_REF вместо "[", чтобы ее нельзя
+# было спутать с таким же текстом; FN_REF удаляется из входных строк и
+# заменяется на "[" при выводе
+FN_REF = "\x00"
+
+# Roman digits for units, tens, hundreds and thousands
+ROMAN_DIGITS = (
+    ("", "I", "II", "III", "IV", "V", "VI", "VII", "VIII", "IX"),
+    ("", "X", "XX", "XXX", "XL", "L", "LX", "LXX", "LXXX", "XC"),
+    ("", "C", "CC", "CCC", "CD", "D", "DC", "DCC", "DCCC", "CM"),
+    ("", "M", "MM", "MMM"),
+)
+ROMAN_MAX = 3999
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+LETTER_MAX = 26 + 26**2 + 26**3 # zzz
+
+# pnum_type -> list of page numbers, built on first use
+PNUM_TABLES = {}
+
+# Ширина и выравнивание строк: str для строк из символов шириной в одну
+# колонку, tfwidth для всех остальных
+STR_JUST = (len, str.ljust, str.rjust, str.center)
+WIDTH_JUST = (text_width, ljust, rjust, center)
+
+# CompiledDocument: операции и версия формата файлов кэша
+OP_TEXT = 0
+OP_COMMAND = 1
+COMPILED_VERSION = 3
+
+# Версия формата файлов индекса страниц
+PAGE_INDEX_VERSION = 1
+
+# Сколько строк разбирается за раз при выводе в несколько форматов
+LAYOUT_BLOCK = 4096
+
+# TextFormat attributes that are not saved by GetState
+STATE_SKIP = ("out", "commands", "stats", "errors")
+
+# EnableStats: methods of TextFormat and of the output writer timed as
+# formatting phases
+STATS_PHASES = {
+    "ProcessStripped": "parse",
+    "ProcessCommand":  "parse",
+    "ProcessOps":      "parse",
+    "FormatLine":      "break",
+    "FormatWords":     "break",
+    "FormatFNLine":    "break",
+    "OptimalBreak":    "break",
+    "Flush":           "break",
+    "LineAlign":       "align",
+    "PrintLine":       "paginate",
+    "FeedLines":       "paginate",
+    "PageClose":       "paginate",
+    "HeaderForm":      "paginate",
+    "FNPlace":         "paginate",
+    "PrintFNotes":     "paginate",
 }
-
-LET_DIG = { 
-    1:"a",
-    2:"b",
-    3:"c",
-    4:"d",
-    5:"e",
-    6:"f",
-    7:"g",
-    8:"h",
-    9:"i",
-    10:"j",
-    11:"k",
-    12:"l",
-    13:"m",
-    14:"n",
-    15:"o",
-    16:"p",
-    17:"q",
-    18:"r",
-    19:"s",
-    20:"t",
-    21:"u",
-    22:"v",
-    23:"w",
-    24:"x",
-    25:"y",
-    26:"z" 
+STATS_WRITER = ("Write", "Header", "Footnotes", "PageBreak", "Flush", "Close")
+
+class LazyPattern():
+    """
+    Regular expression compiled at first use
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.regex = None
+
+    def match(self, s):
+        if self.regex == None:
+            import re
+            self.regex = re.compile(self.pattern)
+        return self.regex.match(s)
+
+
+# command name -> (handler, arguments pattern)
+CMD_TABLE = {
+    "size":       ("CmdSize", LazyPattern(r"^\?size\ +(\d+)?,\ *(\d+)?")),
+    "align":      ("CmdAlign", LazyPattern(r"^\?align\ +(left|right|center|fill|as_is|optimal){1}")),
+    "par":        ("CmdPar", LazyPattern(r"^\?par\ +(\d+)?,\ *(-?\d+)?")),
+    "offset":     ("CmdOffset", LazyPattern(r"^\?offset\ +(\d+)?,\ *(\d+)?")),
+    "interval":   ("CmdInterval", LazyPattern(r"^\?interval\ +(\d+){1}")),
+    "feed":       ("CmdFeed", LazyPattern(r"^\?feed\ +(\d+){1}")),
+    "feed_lines": ("CmdFeedLines", LazyPattern(r"^\?feed_lines\ +(\d+){1}")),
+    "page_break": ("CmdPageBreak", None),
+    "left":       ("CmdLeft", LazyPattern(r"^\?left\ +(\d+){1}")),
+    "header":     ("CmdHeader", LazyPattern(r"^\?header\ +(\d+){1},\ *(\d+){1},\ *(left|right|center|smart){1},\ *(top|bottom){1},\ *(.*)")),
+    "p_num":      ("CmdPNum", LazyPattern(r"^\?p_num\ +(\d+)?,\ *(arabic|roman|letter){1},\ *(.*)")),
+    "br":         ("CmdBr", None),
+    "footnote":   ("CmdFootnote", LazyPattern(r"^\?footnote\ +(\d+){1}")),
+    "alias":      ("CmdAlias", LazyPattern(r"^\?alias\ *(?:(\S),\ ?(.))?$")),
 }
 
+CMD_RE = LazyPattern(r"\?(\w+)(?:\ +|$)")
+
+
+class PageWriter():
+    """
+    Collects formatted output page by page
+
+    Lines are kept in memory until the page is closed and then written to
+    the sink with a single call. flush_pages sets how many pages are
+    collected before writing: 1 - every page, N - every N pages, 0 - only
+    when the document is closed. pages counts the closed pages, the last
+    one is counted by Close.
+    """
+    def __init__(self, sink = None, flush_pages = 1):
+        self.sink = sink if sink != None else sys.stdout
+        self.flush_pages = flush_pages
+        self.buf = []
+        self.pages = 0
+
+    def Write(self, line):
+        self.buf.append(line)
+
+    def Header(self, lines):
+        """
+        Writes the lines of the page header
+        """
+        self.buf.extend(lines)
+
+    def Footnotes(self, lines):
+        """
+        Writes the footnotes at the bottom of the page
+        """
+        self.buf.extend(lines)
+
+    def PageBreak(self):
+        self.buf.append('\f')
+        self.pages += 1
+        if self.flush_pages > 0 and self.pages % self.flush_pages == 0:
+            self.Flush()
+
+    def Flush(self):
+        if len(self.buf) == 0:
+            return
+        self.buf.append("")
+        self.sink.write("\n".join(self.buf))
+        self.buf = []
+        if hasattr(self.sink, "flush"):
+            self.sink.flush()
+
+    def Close(self):
+        # Последняя страница документа закрывается без разрыва
+        self.pages += 1
+        self.Flush()
+
+
+class PageCounter(PageWriter):
+    """
+    Drops formatted output and only counts pages
+    """
+    def Write(self, line):
+        pass
+
+    def Header(self, lines):
+        pass
+
+    def Footnotes(self, lines):
+        pass
+
+    def PageBreak(self):
+        self.pages += 1
+
+    def Flush(self):
+        pass
+
+
+class PageCollector(PageWriter):
+    """
+    Keeps all formatted lines in buf instead of writing them
+    """
+    def Flush(self):
+        pass
+
+
+class Page():
+    """
+    Formatted page
+
+    lines holds all lines of the page in output order, ending with '\f'
+    if the page was closed; header, footnotes and body split them into the
+    lines written by HeaderForm, by PrintFNotes and all the others. A
+    bottom header is written after the '\f' of the page it closes, so it
+    follows the '\f' in lines too. The last page of a document has no
+    bottom header, because the document is closed without a page break.
+    """
+    def __init__(self):
+        self.num = 0
+        self.header = []
+        self.footnotes = []
+        self.body = []
+        self.lines = []
+
+    def Text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class PageQueue(PageWriter):
+    """
+    Collects formatted output into Page objects
+
+    Closed pages are kept in ready until TextFormat.IterPages takes them.
+    """
+    def __init__(self, tf):
+        PageWriter.__init__(self, None, 0)
+        self.tf = tf
+        self.page = Page()
+        self.closed = None
+        self.ready = []
+
+    def Write(self, line):
+        self.page.lines.append(line)
+        self.page.body.append(line)
+
+    def Header(self, lines):
+        # Нижний колонтитул выводится сразу после разрыва и относится
+        # к только что закрытой странице
+        page = self.page
+        if self.tf.header_vpos == HV_BOTTOM and self.closed != None:
+            page = self.closed
+        page.lines.extend(lines)
+        page.header.extend(lines)
+
+    def Footnotes(self, lines):
+        self.page.lines.extend(lines)
+        self.page.footnotes.extend(lines)
+
+    def PageBreak(self):
+        self.page.lines.append('\f')
+        self.pages += 1
+        self.NextPage()
+
+    def Flush(self):
+        pass
+
+    def Close(self):
+        if len(self.page.lines) > 0:
+            self.pages += 1
+            self.NextPage()
+
+    def NextPage(self):
+        self.page.num = self.tf.pnum
+        self.ready.append(self.page)
+        self.closed = self.page
+        self.page = Page()
+
+
+class PageRangeWriter(PageWriter):
+    """
+    Writes only pages skip + 1 ... skip + count
+
+    Other pages are counted and dropped; done is set when the last
+    page of the range is written.
+    """
+    def __init__(self, sink = None, skip = 0, count = 1):
+        PageWriter.__init__(self, sink, 1)
+        self.skip = skip
+        self.count = count
+        self.done = count <= 0
+
+    def Write(self, line):
+        if self.skip <= self.pages < self.skip + self.count:
+            self.buf.append(line)
+
+    def Header(self, lines):
+        if self.skip <= self.pages < self.skip + self.count:
+            self.buf.extend(lines)
+
+    def Footnotes(self, lines):
+        if self.skip <= self.pages < self.skip + self.count:
+            self.buf.extend(lines)
+
+    def PageBreak(self):
+        if self.skip <= self.pages < self.skip + self.count:
+            PageWriter.PageBreak(self)
+        else:
+            self.pages += 1
+        if self.pages >= self.skip + self.count:
+            self.done = True
+
+
+class PageTail(PageWriter):
+    """
+    Keeps only the lines written after the last page break
+    """
+    def PageBreak(self):
+        self.buf = []
+        self.pages += 1
+
+    def Flush(self):
+        pass
+
+
+class StreamWriter(PageWriter):
+    """
+    Writes formatted lines as soon as they are ready
+
+    Lines are written when flush_lines of them are collected or when the
+    first of them has waited flush_time seconds; the time is checked on
+    every line and by Poll, which the reading loop calls while it waits
+    for input.
+    """
+    def __init__(self, sink = None, flush_lines = 1, flush_time = 0.1):
+        PageWriter.__init__(self, sink, 0)
+        self.flush_lines = flush_lines
+        self.flush_time = flush_time
+        # Время, когда в buf попала первая строка
+        self.since = None
+
+    def Write(self, line):
+        self.buf.append(line)
+        self.Check()
+
+    def Header(self, lines):
+        self.buf.extend(lines)
+        self.Check()
+
+    def Footnotes(self, lines):
+        self.buf.extend(lines)
+        self.Check()
+
+    def PageBreak(self):
+        self.buf.append('\f')
+        self.pages += 1
+        self.Check()
+
+    def Check(self):
+        if len(self.buf) == 0:
+            return
+        now = time.monotonic()
+        if self.since == None:
+            self.since = now
+        if len(self.buf) >= self.flush_lines or now - self.since >= self.flush_time:
+            self.Flush()
+
+    def Deadline(self):
+        """
+        Returns the time when buffered lines must be written, or None
+        """
+        return self.since + self.flush_time if self.since != None else None
+
+    def Poll(self):
+        if self.since != None and time.monotonic() >= self.since + self.flush_time:
+            self.Flush()
+
+    def Flush(self):
+        PageWriter.Flush(self)
+        self.since = None
+
+
+class FormatStats():
+    """
+    Counters and timings of a TextFormat
+
+    Time is split into phases: parse, break, align, paginate and emit.
+    A phase does not include the time of phases it calls. Commands are
+    counted with their full time. Hooks are called with the Report dict
+    when the document is closed.
+    """
+    def __init__(self, hooks = ()):
+        self.hooks = list(hooks)
+        self.lines = 0
+        self.output_lines = 0
+        self.pages = 0
+        self.phases = dict.fromkeys(("parse", "break", "align", "paginate", "emit"), 0.0)
+        self.commands = {}
+        self.phase = None
+        self.start = 0.0
+        self.stack = []
+
+    def AddHook(self, hook):
+        self.hooks.append(hook)
+
+    def Enter(self, phase):
+        now = time.perf_counter()
+        if self.phase != None:
+            self.phases[self.phase] += now - self.start
+        self.stack.append(self.phase)
+        self.phase = phase
+        self.start = now
+
+    def Leave(self):
+        now = time.perf_counter()
+        self.phases[self.phase] += now - self.start
+        self.phase = self.stack.pop()
+        self.start = now
+
+    def Phase(self, phase, method):
+        """
+        Returns method wrapped to be timed as phase
+        """
+        def timed(*args, **kw):
+            self.Enter(phase)
+            try:
+                return method(*args, **kw)
+            finally:
+                self.Leave()
+        return timed
+
+    def Command(self, name, handler):
+        """
+        Returns command handler wrapped to be counted and timed
+        """
+        counter = self.commands.setdefault(name, [0, 0.0])
+        def timed(*args, **kw):
+            start = time.perf_counter()
+            try:
+                return handler(*args, **kw)
+            finally:
+                counter[0] += 1
+                counter[1] += time.perf_counter() - start
+        return timed
+
+    def Count(self, name, method):
+        """
+        Returns method wrapped to add 1 to the counter name on every call
+        """
+        def counted(*args, **kw):
+            setattr(self, name, getattr(self, name) + 1)
+            return method(*args, **kw)
+        return counted
+
+    def CountItems(self, name, method):
+        """
+        Returns method wrapped to add the length of its first argument to
+        the counter name on every call
+        """
+        def counted(items, *args, **kw):
+            setattr(self, name, getattr(self, name) + len(items))
+            return method(items, *args, **kw)
+        return counted
+
+    def WrapWriter(self, out):
+        for name in STATS_WRITER:
+            setattr(out, name, self.Phase("emit", getattr(out, name)))
+        out.Write = self.Count("output_lines", out.Write)
+        out.PageBreak = self.Count("pages", out.PageBreak)
+        out.Close = self.Count("pages", out.Close)
+
+    def Report(self):
+        return {
+            "lines": self.lines,
+            "output_lines": self.output_lines,
+            "pages": self.pages,
+            "footnotes": self.commands.get("footnote", (0,))[0],
+            "phases": dict(self.phases),
+            "commands": {name: {"count": c, "seconds": t}
+                for name, (c, t) in self.commands.items() if c > 0},
+        }
+
+    def Done(self):
+        report = self.Report()
+        for hook in self.hooks:
+            hook(report)
+
 
 class TextFormat():
-    def __init__(self, w = 72, h = 40):
+    def __init__(self, w = 72, h = 40, out = None, fill = FILL_ALTERNATE, seed = 0,
+            hyph = None):
+        self.out = out if out != None else PageWriter()
+        # Переносы по шаблонам tfhyph.Hyphenator, None - без переносов
+        self.hyph = hyph
+        self.fill_policy = fill
+        self.fill_seed = seed
+        self.fill_rng = None
+        self.fill_page = None
+        self.fill_right = True
         self.w = w
         self.h = h
         self.left = self.h
@@ -104,6 +554,12 @@ class TextFormat():
         # will be displayed
         self.header_pos = 0
         self.header_text = ""
+        # Header lines prepared by HeaderCompile
+        self.header_lines = None
+        self.header_prefix = ""
+        self.header_just = (None, None)
+        self.header_idx = None
+        self.header_sep = []
         self.indent = 0
         self.offset = (0, 0)
         self.space = 0
@@ -111,22 +567,142 @@ class TextFormat():
         self.pnum_type = PNUM_ARABIC
         self.pnum = 1
         self.pnum_prefix = ""
-        self.prev_line = ""
+        self.par_words = []
+        self.par_len = 0
+        self.par_wide = False
         self.first_line = True
         self.fn_lines = 0
         self.fn_w = self.w
-        self.fn = []
         self.fn_first = True
-        self.fn_lpp = 0
-        self.fn_prev = ""
         self.fn_index = 1
+        self.fn_mark = ""
+        self.fn_words = []
+        # Сноски, ссылка на которые еще не выведена, строки сносок текущей
+        # страницы и строки, не поместившиеся на нее
+        self.fn_wait = deque()
+        self.fn_page = []
+        self.fn_lpp = 0
+        self.fn_carry = deque()
+        # ?alias: заменяемые символы и таблица для str.translate,
+        # которая строится заново только при их изменении
+        self.aliases = {}
+        self.alias_table = None
+        self.commands = {}
+        for name, (handler, pattern) in CMD_TABLE.items():
+            self.commands[name] = (getattr(self, handler), pattern)
+        self.stats = None
+        # Сообщения об ошибках, которые PrintErr вывел в текст
+        self.errors = []
+
+    def EnableStats(self, stats = None):
+        """
+        Starts collecting counters and timings
+
+        Methods are replaced by timed wrappers only on this object, so a
+        TextFormat without stats runs at full speed. Returns the
+        FormatStats object.
+        """
+        if stats == None:
+            stats = FormatStats()
+        self.stats = stats
+        for name, phase in STATS_PHASES.items():
+            setattr(self, name, stats.Phase(phase, getattr(self, name)))
+        self.ProcessStripped = stats.Count("lines", self.ProcessStripped)
+        # Каждая операция CompiledDocument - одна строка исходного текста
+        self.ProcessOps = stats.CountItems("lines", self.ProcessOps)
+        for name, (handler, pattern) in self.commands.items():
+            self.commands[name] = (stats.Command(name, handler), pattern)
+        stats.WrapWriter(self.out)
+        return stats
+
+    def IterPages(self, lines):
+        """
+        Formats lines and yields Page objects
+
+        Pages are yielded as soon as they are closed, so only the current
+        page is kept in memory. The document is closed at the end.
+        """
+        out = self.out
+        self.out = PageQueue(self)
+        if self.stats != None:
+            self.stats.WrapWriter(self.out)
+        try:
+            for l in lines:
+                self.ProcessLine(l)
+                if len(self.out.ready) > 0:
+                    yield from self.out.ready
+                    self.out.ready.clear()
+            self.Flush(True)
+            yield from self.out.ready
+            self.out.ready.clear()
+        finally:
+            self.out = out
+
+    def IterLines(self, lines):
+        """
+        Formats lines and yields output lines
+
+        Lines are yielded page by page without line endings, page breaks
+        as '\f'.
+        """
+        for page in self.IterPages(lines):
+            yield from page.lines
 
     def ProcessLine(self, line):
-        line = self.RemoveCRLF(line)
-        if re.match(r"^\?\w+\ +.*", line) != None and self.fn_lines == 0:
-            self.ProcessCommand(line)
-        else:
-            self.FormatLine(line)
+        self.ProcessStripped(self.RemoveCRLF(line))
+
+    def ProcessStripped(self, line):
+        """
+        Processes a line without line ending
+        """
+        # Обычные строки текста не проходят через регулярные выражения
+        if line[:1] == '?' and self.fn_lines == 0:
+            if self.ProcessCommand(line):
+                return
+        if self.alias_table != None:
+            line = line.translate(self.alias_table)
+        if FN_REF in line:
+            line = line.replace(FN_REF, "")
+        self.FormatLine(line)
+        if self.left == 0:
+            self.PageClose()
+
+    def ProcessCompiled(self, doc):
+        """
+        Processes a CompiledDocument
+
+        Same as ProcessLine for every source line, but command arguments
+        and stripped text lines with their widths are taken from the
+        document.
+        """
+        self.ProcessOps(doc.ops)
+
+    def ProcessOps(self, ops):
+        """
+        Processes operations of a CompiledDocument
+        """
+        for op in ops:
+            if op[0] == OP_COMMAND:
+                _, name, groups, line = op
+                cmd = self.commands.get(name)
+                if cmd != None:
+                    handler, pattern = cmd
+                    if pattern == None:
+                        handler(line)
+                    elif name in CMD_TABLE and pattern is CMD_TABLE[name][1]:
+                        handler(line, CompiledMatch(groups) if groups != None else None)
+                    else:
+                        handler(line, pattern.match(line))
+                continue
+            _, line, text, line_len, narrow = op
+            if self.fn_lines > 0 or self.align == A_AS_IS or self.align == A_OPTIMAL:
+                self.FormatLine(line if line != None else text)
+            elif text == "":
+                self.Flush()
+            else:
+                if not narrow:
+                    self.par_wide = True
+                self.FormatWords(text.split(' '), line_len)
             if self.left == 0:
                 self.PageClose()
 
@@ -143,28 +719,78 @@ class TextFormat():
             self.Flush()
             return
 
-        if self.prev_line != "":
-            line = self.prev_line + ' ' + line 
+        # Ширина абзаца, в котором есть широкие или комбинируемые символы,
+        # считается через tfwidth
+        if not self.par_wide and not line.isascii() and not is_narrow(line):
+            self.par_wide = True
+        width = text_width if self.par_wide else len
+
+        # Строки абзаца с оптимальными переносами выводятся целиком в Flush
+        if self.align == A_OPTIMAL:
+            self.par_words.extend(line.split())
+            return
+
+        self.FormatWords(line.split(' '), width(line))
+
+    def FormatWords(self, line_words, line_len):
+        """
+        Adds words of a stripped line to the paragraph
+
+        line_len is the width of the line. Prints all lines of the
+        paragraph that are full.
+        """
+        width = text_width if self.par_wide else len
+
+        # Абзац хранится списком слов и его шириной, чтобы не склеивать
+        # и не резать строку заново для каждой выводимой строки
+        words = self.par_words
+        prev_n, prev_len = len(words), self.par_len
+        if prev_n > 0:
+            self.par_len += 1 + line_len
+        else:
+            self.par_len = line_len
+        words.extend(line_words)
+
         cw = self.w - self.offset[0] - self.offset[1]
         if self.first_line:
         #    self.FeedLines(self.space)
             cw -= self.indent
-       
-        while len(line) >= cw:
-            s, line = self.LineCut(line, cw)
-            if s == "":
-                self.PrintLine(line, False)
-                break
-            # Отформатировать строку в соответствии с текущими 
-            # настройками выравнивания
-            s = self.LineAlign(s, cw)
-            # Вывести строку в стандартный вывод
+
+        i = 0
+        while self.par_len >= cw:
+            j, lw = self.WordCut(words, i, cw, width)
+            if self.hyph != None:
+                k = self.Hyphenate(words, i, j, cw, width)
+                if k != j:
+                    self.par_len += 2
+                    j = k
+                    lw = width(' '.join(words[i:j + 1]))
+            if j < 0 or (j == i and words[i] == ""):
+                # Слово не помещается в строку: вывести остаток как есть
+                self.PrintLine(' '.join(words[j + 1 if j >= 0 else i:]), False)
+                del words[prev_n:]
+                self.par_len = prev_len
+                return
+            self.par_len -= lw + 1
+            self.PrintWords(words, i, j, lw, cw)
+            i = j + 1
             self.first_line = False
             cw = self.w - self.offset[0] - self.offset[1]
-            self.PrintLine(s)
 
-        else:
-            self.prev_line = line
+        del words[:i]
+
+    def PrintWords(self, words, i, j, lw, cw):
+        """
+        Prints a line of the paragraph
+
+        The line is words[i:j + 1], lw is its width and cw the width it
+        is aligned to.
+        """
+        # Отформатировать строку в соответствии с текущими 
+        # настройками выравнивания
+        s = self.LineAlign(' '.join(words[i:j + 1]), cw)
+        # Вывести строку в стандартный вывод
+        self.PrintLine(s)
 
     def PrintLine(self, line, add_interval = True):
         """
@@ -175,12 +801,25 @@ class TextFormat():
         if self.left == 0:
             self.PageClose()
 
-        print(line)
-        self.left -= 1
+        if len(self.fn_wait) > 0 and self.fn_wait[0][0] in line:
+            # Строка со ссылкой переносится на следующую страницу, если
+            # под ней не остается места хотя бы для одной строки сноски
+            if self.left < 2 + (self.fn_lpp == 0):
+                self.PageClose()
+            self.out.Write(line.replace(FN_REF, "["))
+            self.left -= 1
+            while len(self.fn_wait) > 0 and self.fn_wait[0][0] in line:
+                self.FNPlace(self.fn_wait.popleft()[1])
+        else:
+            # Ссылка на сноску, текст которой еще не прочитан
+            if FN_REF in line:
+                line = line.replace(FN_REF, "[")
+            self.out.Write(line)
+            self.left -= 1
         if add_interval:
             for l in range(self.interval - 1):
                 if self.left > 0:
-                    print("")
+                    self.out.Write("")
                     self.left -= 1
 
     def PrintErr(self, line):
@@ -189,12 +828,16 @@ class TextFormat():
 
 
         """
-        print("")
-        print("  >>> ERROR: " + line)
-        print("")
+        self.errors.append(line)
+        self.out.Write("")
+        self.out.Write("  >>> ERROR: " + line)
+        self.out.Write("")
 
     def PrintSym(self, sym):
-        print(sym)
+        if sym == '\f':
+            self.out.PageBreak()
+        else:
+            self.out.Write(sym)
 
     def LineAlign(self, s, normal_str = True):
         if normal_str:
@@ -205,86 +848,125 @@ class TextFormat():
             ln = self.fn_w - FN_OFFSET
             if self.fn_first:
                 ln -= FN_INDENT
+        # Строки абзаца проверены в FormatLine
+        if self.par_wide if normal_str else not is_narrow(s):
+            width, lj, rj, cn = WIDTH_JUST
+        else:
+            width, lj, rj, cn = STR_JUST
 
         if self.align == A_RIGHT:
-            s = s.rjust(ln)
+            s = rj(s, ln)
 
         elif self.align == A_CENTER:
-            s = s.center(ln)
+            s = cn(s, ln)
 
         elif self.align == A_FILL:
             # Разбить строку на слова
             ww = s.split()
-            if len(ww) > 1:
-                # Посчитать суммарную длину всех слов
-                wln = 0
-                for w in ww:
-                    wln += len(w)
-                # Определить минимальное количество пробелов в строке
-                min_s = int((ln - wln) / (len(ww) - 1))
-                # Расставить в случайные позиции оставшиеся пробелы
-                sp = ln - wln - min_s * (len(ww) - 1)
-                spp = set()
-                while sp > 0:
-                    sppl = len(spp)
-                    spp.add(random.randint(0, len(ww) - 2))
-                    if len(spp) > sppl:
-                        sp -= 1
-                s = ww[0]
-                for p, w in enumerate(ww[1:]):
-                    if p in spp:
-                        s += " "
-                    s += w.rjust(len(w) + min_s)
-
+            gaps = len(ww) - 1
+            if gaps > 0:
+                # Определить минимальное количество пробелов между словами
+                # и сколько промежутков получат по одному лишнему пробелу
+                min_s, sp = divmod(ln - sum(map(width, ww)), gaps)
+                parts = [" " * min_s] * (2 * gaps + 1)
+                parts[::2] = ww
+                if sp > 0:
+                    for p in self.FillGaps(gaps, sp):
+                        parts[2 * p + 1] = " " * (min_s + 1)
+                s = "".join(parts)
 
         if normal_str:
-            s = s.ljust(ln + self.offset[1])
+            s = lj(s, ln + self.offset[1])
             if self.first_line:
-                s = s.rjust(ln + self.offset[0] + self.indent)
+                s = rj(s, ln + self.offset[0] + self.indent)
             else:
-                s = s.rjust(ln + self.offset[0])
+                s = rj(s, ln + self.offset[0])
         else:
+            s = lj(s, ln)
             if self.fn_first:
-                s = s.rjust(ln + FN_OFFSET + FN_INDENT)
+                s = rj(s, ln + FN_OFFSET + FN_INDENT)
             else:
-                s = s.rjust(ln + FN_OFFSET)
-            
-                
+                s = rj(s, ln + FN_OFFSET)
+
         return s
 
+    def FillGaps(self, gaps, sp):
+        """
+        Chooses gaps for extra spaces
+
+        Returns indexes of sp gaps out of gaps that get one more space in
+        fill alignment, according to fill_policy
+        """
+        if self.fill_policy == FILL_RANDOM:
+            # Генератор пересоздается на каждой странице, чтобы
+            # результат не зависел от предыдущих страниц
+            if self.fill_page != self.pnum:
+                self.fill_page = self.pnum
+                import random
+                self.fill_rng = random.Random(self.fill_seed * 1000003 + self.pnum)
+            return self.fill_rng.sample(range(gaps), sp)
+        if self.fill_policy == FILL_ALTERNATE:
+            self.fill_right = not self.fill_right
+            right = self.fill_right
+        else:
+            right = self.fill_policy == FILL_RIGHT
+        if right:
+            return range(gaps - sp, gaps)
+        return range(sp)
+
     def HeaderForm(self):
         if self.header_hpos == H_NONE or self.header_h == 0:
             return
-        
+        if self.header_lines == None:
+            self.HeaderCompile()
+
+        # Нижний колонтитул начинается с разделителя, который выводится
+        # до номера страницы и возможного сообщения об ошибке в нем
         if self.header_vpos == HV_BOTTOM:
-            print("="*self.w)
+            self.out.Header(self.header_sep)
+
+        h = self.header_prefix + self.GetPNum()
+        just = self.header_just[self.pnum % 2]
+        if just != None:
+            h = just(h, self.w)
+        if self.header_idx != None:
+            self.header_lines[self.header_idx] = h
+        self.out.Header(self.header_lines)
 
+    def HeaderCompile(self):
+        """
+        Prepares header lines
+
+        Called on the first page after the header, page number style or
+        page width has changed. Only the page number is formatted on
+        every page.
+        """
         if self.header_text != "":
-            h = self.header_text + " "
+            self.header_prefix = self.header_text + " "
         else:
-            h = ""
-
-        h += self.GetPNum()
+            self.header_prefix = ""
 
+        # Выравнивание для четных и нечетных страниц
+        _, _, rj, cn = STR_JUST if is_narrow(self.header_prefix + self.pnum_prefix) else WIDTH_JUST
         if self.header_hpos == H_RIGHT:
-            h = h.rjust(self.w)
+            self.header_just = (rj, rj)
         elif self.header_hpos == H_CENTER:
-            h = h.center(self.w)
+            self.header_just = (cn, cn)
         elif self.header_hpos == H_SMART:
-            if self.pnum % 2 == 0:
-                h = h.rjust(self.w)
-        
-        for i in range(self.header_h):
-            if i + 1 == self.header_pos:
-                print(h)
-            else:
-                print("")
-        
+            self.header_just = (rj, None)
+        else:
+            self.header_just = (None, None)
+
+        lines = [""] * self.header_h
+        if self.header_pos >= 1 and self.header_pos <= self.header_h:
+            self.header_idx = self.header_pos - 1
+        else:
+            self.header_idx = None
+        self.header_sep = ["="*self.w]
         if self.header_vpos == HV_TOP:
-            print("="*self.w)
-        
+            lines += self.header_sep
+        self.header_lines = lines
 
-        
     def GetPNum(self):
         """
         Gets page number
@@ -293,118 +975,226 @@ class TextFormat():
         """
         if self.pnum_type == PNUM_ARABIC:
             pn = str(self.pnum)
-        elif self.pnum_type == PNUM_ROMAN:
-            if self.pnum > 3999:
+        else:
+            table = pnum_table(self.pnum_type)
+            if self.pnum < len(table):
+                pn = table[self.pnum]
+            elif self.pnum_type == PNUM_ROMAN:
                 self.PrintErr("Page number is too large for roman style " + str(self.pnum))
                 pn = "<TOO LARGE>"
             else:
-                th = self.pnum // 1000
-                hd = (self.pnum - th * 1000) // 100
-                dc = (self.pnum - th * 1000 - hd * 100) // 10
-                en = (self.pnum - th * 1000 - hd * 100 - dc * 10)
-                pn = RM_DIG[1000]*th
-                if hd*100 in RM_DIG:
-                    pn += RM_DIG[hd * 100]
-                else:
-                    if hd > 5:
-                        pn += RM_DIG[500] + RM_DIG[100]*(hd - 5)
-                    else:
-                        pn += RM_DIG[100] * hd
-                if dc*10 in RM_DIG:
-                    pn += RM_DIG[dc * 10]
-                else:
-                    if dc > 5:
-                        pn += RM_DIG[50] + RM_DIG[10]*(dc - 5)
-                    else:
-                        pn += RM_DIG[10] * dc
-                if en != 0:
-                    pn += RM_DIG[en]
-            
-        elif self.pnum_type == PNUM_LETTER:
-            if self.pnum > 17602:
-                self.PrintErr("Page number is too large for letter style" + str(self.pnum))
+                self.PrintErr("Page number is too large for letter style " + str(self.pnum))
                 pn = "<TOO LARGE>"
-            elif self.pnum == 0:
-                pn = int(self.pnum)
-            else:
-                if self.pnum < 27:
-                    pn = LET_DIG[self.pnum]
-                else:
-                    aa = self.pnum // 26
-                    left = self.pnum - aa * 26
-                    if aa < 27:
-                        pn = LET_DIG[aa] + LET_DIG[left]
-                    else:
-                        bb = aa // 26
-                        aa -= bb * 26
-                        left = self.pnum - aa*26 - bb*26**2
-                        pn = LET_DIG[bb] + LET_DIG[aa] + LET_DIG[left]
 
         if self.pnum_prefix != "":
             pn = self.pnum_prefix + ' ' + pn
         return pn
         
 
-    def LineCut(self, line, cw):
+    def WordCut(self, words, i, cw, width = len):
         """
-        Cuts a lines
+        Finds a line break in a word list
 
+        Returns index of the last word starting from words[i] that fits
+        into cw, the last space before cw in ' '.join(words[i:]), or -1
+        if there is no space to break at, and the width of the line up to
+        that word. width measures the words.
+        """
+        j = -1
+        lw = pos = width(words[i])
+        n = len(words)
+        while i + 1 < n and pos < cw:
+            j = i
+            lw = pos
+            i += 1
+            pos += 1 + width(words[i])
+        return j, lw
+
+    def Hyphenate(self, words, i, j, cw, width = len):
+        """
+        Hyphenates the word after a line break
 
+        words[i:j + 1] is the line found by WordCut. If a head of the next
+        word fits into the line, the word is replaced by the head with a
+        hyphen and the rest, so the text becomes 2 columns wider. Returns
+        the index of the new last word of the line or j.
         """
-        # Отрезать от строки подстроку шириной не более текущей ширины
-        # параграфа по пробелам
-        
-        last_space = line.rfind(' ', 0, cw)
-        if last_space >= 0:
-            s = line[:last_space]
-            line = line[last_space + 1:]
-        else:
-            s = ""
+        k = j + 1 if j >= 0 else i
+        room = cw - 1
+        if j >= 0:
+            room -= width(' '.join(words[i:k])) + 1
+        if room < 2 or k >= len(words):
+            return j
+        parts = self.hyph.Split(words[k], room, width)
+        if parts == None:
+            return j
+        words[k:k + 1] = parts
+        return k
+
+    def OptimalBreak(self):
+        """
+        Breaks a paragraph with minimal raggedness
+
+        Prints all lines of the paragraph except the last one, which is
+        left in par_words. Break points minimize the sum of squared free
+        space over all lines but the last. Only lines leaving no more than
+        1/OPT_TOLERANCE of the width free are considered, so every break
+        has a few candidates and the cost is linear in the number of words.
+        """
+        words = self.par_words
+        n = len(words)
+        cw = self.w - self.offset[0] - self.offset[1] - 1
+        first_cw = cw - self.indent
+
+        # pos[k] - ширина первых k слов вместе с пробелом после каждого
+        width = text_width if self.par_wide else len
+        pos = list(accumulate([width(w) + 1 for w in words], initial = 0))
+
+        # Из каждого достижимого переноса i рассматриваются концы строки
+        # от самой длинной помещающейся строки j до самой короткой,
+        # оставляющей свободными не больше tol позиций. Последняя строка
+        # абзаца может быть любой длины.
+        tol = max(cw // OPT_TOLERANCE, 1)
+        inf = float("inf")
+        cost = [inf] * (n + 1)
+        cost[0] = 0
+        brk = [0] * (n + 1)
+        j = 1
+        for i in range(n):
+            ci = cost[i]
+            if ci == inf:
+                continue
+            lim = (first_cw if i == 0 else cw) + pos[i] + 1
+            if j <= i:
+                j = i + 1
+            while j < n and pos[j + 1] <= lim:
+                j += 1
+            while j > i + 1 and pos[j] > lim:
+                j -= 1
+            if pos[j] > lim:
+                # Слово длиннее строки остается в строке одно
+                if ci < cost[j]:
+                    cost[j] = ci
+                    brk[j] = i
+                continue
+            k = j
+            while k > i:
+                free = lim - pos[k]
+                if free > tol and k < j:
+                    break
+                c = ci if k == n else ci + free * free
+                if c < cost[k]:
+                    cost[k] = c
+                    brk[k] = i
+                k -= 1
+
+        breaks = []
+        j = n
+        while j > 0:
+            breaks.append(brk[j])
+            j = brk[j]
+        breaks.reverse()
+
+        cw += 1
+        for k in range(len(breaks) - 1):
+            s = self.LineAlign(' '.join(words[breaks[k]:breaks[k + 1]]), cw)
+            self.first_line = False
+            self.PrintLine(s)
+        del words[:breaks[-1]]
 
-        return s, line
-              
     def FormatFNLine(self, line):
-        if len(line) == 0:
-            return
+        """
+        Collects a line of footnote text
 
-        self.fn_lines -= 1 
-        cw = self.fn_w - FN_OFFSET
+        When the last line of the footnote is read, the footnote is
+        formatted and queued until the line with its reference is printed.
+        """
+        line = line.strip()
+        if line == "":
+            return
+        self.fn_lines -= 1
+        self.fn_words.extend(line.split())
+        if self.fn_lines == 0:
+            self.FNQueue()
 
-        if self.fn_first:
-            cw -= FN_INDENT
-       
-        if self.fn_prev != "":
-            line = self.fn_prev + " " + line
+    def FNQueue(self):
+        self.fn_wait.append((self.fn_mark, self.FNForm(self.fn_words)))
+        self.fn_words = []
 
-        while len(line) >= cw:
-            s, line = self.LineCut(line, cw)
-            if s == "":
-                self.PrintLine(line, False)
+    def FNForm(self, words):
+        """
+        Breaks footnote words into aligned lines
+        """
+        lines = []
+        self.fn_first = True
+        cw = self.fn_w - FN_OFFSET - FN_INDENT
+        i = 0
+        text = ' '.join(words)
+        width = len if is_narrow(text) else text_width
+        rest = width(text)
+        while rest >= cw:
+            j, _ = self.WordCut(words, i, cw, width)
+            if self.hyph != None:
+                k = self.Hyphenate(words, i, j, cw, width)
+                if k != j:
+                    rest += 2
+                    j = k
+            if j < 0:
+                # Слово не помещается в строку: вывести остаток как есть
+                lines.append(' '.join(words[i:]))
                 break
-            # Отформатировать строку в соответствии с текущими 
-            # настройками выравнивания
-            s = self.LineAlign(s, cw)
-            # Вывести строку в стандартный вывод
+            s = ' '.join(words[i:j + 1])
+            rest -= width(s) + 1
+            i = j + 1
+            lines.append(self.LineAlign(s, False))
             self.fn_first = False
-            cw = self.w - FN_OFFSET
-            self.fn.insert(0,self.LineAlign(line, False))
-            self.fn_first = True
-            if self.left > 0:
-                self.left -= 1
-                self.fn_lpp += 1 
+            cw = self.fn_w - FN_OFFSET
+        else:
+            lines.append(self.LineAlign(' '.join(words[i:]), False))
+        self.fn_first = True
+        return lines
 
+    def FNPlace(self, lines, keep = 0):
+        """
+        Places footnote lines at the bottom of the current page
+
+        Space is reserved by decreasing left, keep lines are left for the
+        text. Lines that do not fit are carried to the next page.
+        """
+        if len(self.fn_carry) > 0:
+            self.fn_carry.extend(lines)
+            return
+        sep = 0 if self.fn_lpp > 0 else 1
+        k = min(len(lines), self.left - keep - sep)
+        if k > 0:
+            if sep:
+                self.fn_page.append("-" * self.fn_w)
+            self.fn_page.extend(lines[:k])
+            self.fn_lpp += k + sep
+            self.left -= k + sep
         else:
-            if self.fn_lines == 0:
-                self.fn.insert(0,self.LineAlign(line, False))
-                self.fn_first = True
-                if self.left > 0:
-                    self.left -= 1
-                    self.fn_lpp += 1 
-            else:
-                self.fn_prev = line 
+            k = 0
+        self.fn_carry.extend(lines[k:])
+
+    def PrintFNotes(self):
+        """
+        Prints footnotes of the current page
+
+        Footnotes are pushed to the bottom of the page by the free lines.
+        """
+        if self.fn_lpp == 0:
+            return
+        for i in range(self.left):
+            self.out.Write("")
+        self.left = 0
+        self.out.Footnotes(self.fn_page)
+        self.fn_page = []
+        self.fn_lpp = 0
 
     def PageInit(self):
-        pass
+        if len(self.fn_carry) > 0:
+            lines, self.fn_carry = list(self.fn_carry), deque()
+            self.FNPlace(lines, 1)
 
     def PageClose(self, not_start_new_page = False):
         """
@@ -412,6 +1202,7 @@ class TextFormat():
 
         Closes page and start new page
         """
+        self.PrintFNotes()
         self.PrintSym('\f')
         self.left = self.h - self.header_h - 1
         if self.header_vpos == HV_BOTTOM:
@@ -443,72 +1234,129 @@ class TextFormat():
         if self.left == 0:
             self.PageClose()
 
-        self.PrintLine(self.LineAlign(self.prev_line))
+        if self.align == A_OPTIMAL and len(self.par_words) > 0:
+            self.OptimalBreak()
+        self.PrintLine(self.LineAlign(' '.join(self.par_words)))
         
-        self.prev_line = ""
+        self.par_words = []
+        self.par_len = 0
+        self.par_wide = False
         self.FeedLines(self.space)
         self.first_line = True
 
         if close_document:
+            if self.fn_lines > 0:
+                self.fn_lines = 0
+                self.FNQueue()
+            while len(self.fn_wait) > 0:
+                self.FNPlace(self.fn_wait.popleft()[1])
+            while len(self.fn_carry) > 0:
+                self.PageClose()
             self.PrintFNotes()
+            self.out.Close()
+            if self.stats != None:
+                self.stats.Done()
 
-    def PrintFNotes(self):
-        pass
-        
     def ProcessCommand(self, line):
         """
         Calling commands
 
+        Returns False if the line is not a command
+        """
+        m = CMD_RE.match(line)
+        if m == None:
+            return False
+        cmd = self.commands.get(m.group(1))
+        if cmd != None:
+            handler, pattern = cmd
+            if pattern != None:
+                handler(line, pattern.match(line))
+            else:
+                handler(line)
+        return True
 
+    def RegisterCommand(self, name, handler, pattern = None):
         """
-        m = re.match(r"^\?(\w+)\ +.*", line)
-        if m != None:
-            cmd = m.group(1)
-            if cmd == "size":
-                self.CmdSize(line)
-            elif cmd == "align":
-                self.CmdAlign(line)
-            elif cmd == "par":
-                self.CmdPar(line)
-            elif cmd == "offset":
-                self.CmdOffset(line)
-            elif cmd == "interval":
-                self.CmdInterval(line)
-            elif cmd == "feed":
-                self.CmdFeed(line)
-            elif cmd == "feed_lines":
-                self.CmdFeedLines(line)
-            elif cmd == "page_break":
-                self.CmdPageBreak(line)
-            elif cmd == "left":
-                self.CmdLeft(line)
-            elif cmd == "header":
-                self.CmdHeader(line)
-            elif cmd == "p_num":
-                self.CmdPNum(line)
-            elif cmd == "br":
-                self.CmdBr(line)
-            elif cmd == "footnote":
-                self.CmdFootnote(line)
-            elif cmd == "alias":
-                self.CmdAlias(line)
-                
-        else:
-            self.PrintErr("Unknown command: " + cmd)
+        Adds a command
+
+        handler is called as handler(line, m) where m is the result of
+        matching pattern against the command line, or as handler(line)
+        if pattern is None.
+        """
+        if pattern != None and isinstance(pattern, str):
+            pattern = LazyPattern(pattern)
+        if self.stats != None:
+            handler = self.stats.Command(name, handler)
+        self.commands[name] = (handler, pattern)
         
-    def CmdSize(self, line):
+    def GetState(self):
+        """
+        Returns formatter state
+
+        The state is a copy of all attributes except the output writer and
+        the command table. SetState on a new TextFormat continues
+        formatting exactly where this one stopped.
+        """
+        state = {}
+        for k, v in self.__dict__.items():
+            if k not in STATE_SKIP and k not in STATS_PHASES:
+                state[k] = v
+        # Состояние генератора хранится так, чтобы состояния можно было
+        # сравнивать
+        if self.fill_rng != None:
+            state["fill_rng"] = self.fill_rng.getstate()
+        import copy
+        return copy.deepcopy(state)
+
+    def Checkpoint(self):
+        """
+        Returns formatter state for SetState faster than GetState
+
+        Only lists, dicts and deques are copied, one level deep: their items
+        are strings, numbers and tuples, and footnote line lists are never
+        changed in place.
+        """
+        state = {}
+        for k, v in self.__dict__.items():
+            if k in STATE_SKIP or k in STATS_PHASES:
+                continue
+            if type(v) is list or type(v) is dict:
+                v = v.copy()
+            elif type(v) is deque:
+                v = deque(v)
+            state[k] = v
+        if self.fill_rng != None:
+            state["fill_rng"] = self.fill_rng.getstate()
+        return state
+
+    def SetState(self, state):
+        """
+        Restores formatter state saved by GetState or Checkpoint
+        """
+        import copy
+        state = copy.deepcopy(state)
+        if state["fill_rng"] != None:
+            import random
+            rng = random.Random()
+            rng.setstate(state["fill_rng"])
+            state["fill_rng"] = rng
+        self.__dict__.update(state)
+
+    def CmdSize(self, line, m = None):
         """
         Change size of text
 
 
         """
-        m = re.match(r"^\?size\ +(\d+)?,\ *(\d+)?", line)
         if m != None:
             if m.group(1) != None:
                 h = int(m.group(1))
                 if h < MIN_PAGE_SIZE[0]:
                     self.PrintErr("Page height coudn't be less than " + str(MIN_PAGE_SIZE[0]))
                     h = self.h
+                elif h > MAX_PAGE_SIZE[0]:
+                    self.PrintErr("Page height coudn't be more than " + str(MAX_PAGE_SIZE[0]))
+                    h = self.h
             else:
                 h = self.h
             if m.group(2) != None:
@@ -516,6 +1364,9 @@ class TextFormat():
                 if w < MIN_PAGE_SIZE[1]:
                     self.PrintErr("Page width coudn't be less than " + str(MIN_PAGE_SIZE[1]))
                     w = self.w
+                elif w > MAX_PAGE_SIZE[1]:
+                    self.PrintErr("Page width coudn't be more than " + str(MAX_PAGE_SIZE[1]))
+                    w = self.w
             else:
                 w = self.w
             if self.left > 0:
@@ -533,13 +1384,14 @@ class TextFormat():
                 self.PageInit()
             else:
                 self.h, self.w = h, w
+            self.fn_w = self.w
+            self.header_lines = None
             if not flushed:
                 self.Flush()
         else:
             self.PrintErr("Invalid size command: " + line)
     
-    def CmdAlign(self, line):
-        m = re.match(r"^\?align\ +(left|right|center|fill|as_is){1}", line)
+    def CmdAlign(self, line, m = None):
         if m != None:
             align = m.group(1)
             if align == "left":
@@ -557,16 +1409,18 @@ class TextFormat():
             elif align == "as_is":
                 self.Flush()
                 self.align = A_AS_IS          
+            elif align == "optimal":
+                self.Flush()
+                self.align = A_OPTIMAL
         else:
             self.PrintErr("Invalid align type: " + line)
 
-    def CmdPar(self, line):
+    def CmdPar(self, line, m = None):
         """
         Add paragraphs
 
         Change paragraphs characteristics       
         """
-        m = re.match(r"^\?par\ +(\d+)?,\ *(-?\d+)?", line)
         if m != None:
             self.Flush()
             if m.group(1) != None:
@@ -581,13 +1435,12 @@ class TextFormat():
             #indent is not stable across lines
 
 
-    def CmdOffset(self, line):
+    def CmdOffset(self, line, m = None):
         """
         Sets indents
 
         Change paragraphs characteristics
         """
-        m = re.match(r"^\?offset\ +(\d+)?,\ *(\d+)?", line)
         if m != None:
             self.Flush()
             if m.group(1) != None:
@@ -607,13 +1460,12 @@ class TextFormat():
         else:
             self.PrintErr("Invalid offset command [" + line + "]")
 
-    def CmdInterval(self, line):
+    def CmdInterval(self, line, m = None):
         """
         Sets space between lines
 
 
         """
-        m = re.match(r"^\?interval\ +(\d+){1}", line)
         if m != None:
             try:
                 newInt = int(m.group(1))
@@ -626,13 +1478,12 @@ class TextFormat():
         else:
             self.PrintErr("Invalid interval command [" + line + "]")
 
-    def CmdFeed(self, line):\
+    def CmdFeed(self, line, m = None):
         """
         Adds empty lines with intervals
 
 
         """
-        m = re.match(r"^\?feed\ +(\d+){1}", line)
         if m != None:
             try:
                 n = int(m.group(1))
@@ -645,13 +1496,12 @@ class TextFormat():
         else:
             self.PrintErr("Invalid feed command [" + line + "]")
 
-    def CmdFeedLines(self, line):
+    def CmdFeedLines(self, line, m = None):
         """
         Adds empty lines
 
 
         """
-        m = re.match(r"^\?feed_lines\ +(\d+){1}", line)
         if m != None:
             try:
                 n = int(m.group(1))
@@ -664,7 +1514,7 @@ class TextFormat():
         else:
             self.PrintErr("Invalid feed lines command [" + line + "]")
 
-    def CmdPageBreak(self, line):
+    def CmdPageBreak(self, line, m = None):
         """
         Closes the page
 
@@ -672,14 +1522,13 @@ class TextFormat():
         """
         self.PageClose()
 
-    def CmdLeft(self, line):
+    def CmdLeft(self, line, m = None):
         """
         Closes current paragraph
 
         Checks quantity lines are left on page
         """
         self.Flush()
-        m = re.match(r"^\?left\ +(\d+){1}", line)
         if m != None:
             try:
                 ll = int(m.group(1))
@@ -692,13 +1541,12 @@ class TextFormat():
         else:
             self.PrintErr("Invalid left command: " + line)
 
-    def CmdHeader(self, line):
+    def CmdHeader(self, line, m = None):
         """
         Creates a header based on specifications
 
 
         """
-        m = re.match(r"^\?header\ +(\d+){1},\ *(\d+){1},\ *(left|right|center|smart){1},\ *(top|bottom){1},\ *(.*)", line)
         if m != None:
             try:
                 hh = int(m.group(1))
@@ -722,6 +1570,7 @@ class TextFormat():
                 return
 
             self.header_text = m.group(5)
+            self.header_lines = None
             if m.group(3) == "right":
                 self.header_hpos = H_RIGHT
             elif m.group(3) == "center":
@@ -736,13 +1585,12 @@ class TextFormat():
             else:
                 self.header_vpos = HV_BOTTOM
             
-    def CmdPNum(self, line):
+    def CmdPNum(self, line, m = None):
         """
         Sets new page number
 
 
         """
-        m = re.match(r"^\?p_num\ +(\d+)?,\ *(arabic|roman|letter){1},\ *(.*)", line)
         if m != None:
             self.pnum = int(m.group(1))
             if m.group(2) == "arabic":
@@ -752,8 +1600,9 @@ class TextFormat():
             elif m.group(2) == "letter":
                 self.pnum_type = PNUM_LETTER
             self.pnum_prefix = m.group(3)
+            self.header_lines = None
 
-    def CmdBr(self, line):
+    def CmdBr(self, line, m = None):
         """
         Closes current paragraph
 
@@ -761,28 +1610,1119 @@ class TextFormat():
         """
         self.Flush()
 
-    def CmdFootnote(self, line):
-        m = re.match(r"^\?footnote\ +(\d+){1}", line)
+    def CmdFootnote(self, line, m = None):
         if m != None:
+            ref = "[" + str(self.fn_index) + "]"
+            self.fn_index += 1
+            # В абзаце ссылка отмечена FN_REF и находится по этой отметке
+            self.fn_mark = FN_REF + ref[1:]
+            if len(self.par_words) > 0:
+                self.par_words[-1] += self.fn_mark
+            else:
+                self.par_words.append(self.fn_mark)
+            self.par_len += len(ref)
+            # Текст сноски начинается с ее номера
+            self.fn_words = [ref]
             self.fn_lines = int(m.group(1))
-            self.prev_line += "[" + str(self.fn_index) + "]"
-            if (self.fn_index == 1 and self.left < 3) or (self.left < 2):
-                self.PageClose()
+            if self.fn_lines == 0:
+                self.FNQueue()
+
+    def CmdAlias(self, line, m = None):
+        """
+        Sets an alias
+
+        Text lines after the command have <fictional> replaced with <real>;
+        ?alias without arguments removes all aliases.
+        """
+        if m != None:
+            if m.group(1) != None:
+                self.aliases[m.group(1)] = m.group(2)
+                self.alias_table = str.maketrans(self.aliases)
+            else:
+                self.aliases = {}
+                self.alias_table = None
+        else:
+            self.PrintErr("Invalid alias command: " + line)
+
+
+
+def pnum_table(pnum_type):
+    """
+    Returns page numbers in roman or letter style
+
+    The list is indexed by page number and covers 0..ROMAN_MAX or
+    0..LETTER_MAX.
+    """
+    table = PNUM_TABLES.get(pnum_type)
+    if table == None:
+        if pnum_type == PNUM_ROMAN:
+            d = ROMAN_DIGITS
+            table = [d[3][n // 1000] + d[2][n // 100 % 10] + d[1][n // 10 % 10] + d[0][n % 10]
+                for n in range(ROMAN_MAX + 1)]
+        else:
+            two = [a + b for a in LETTERS for b in LETTERS]
+            table = ["0"] + list(LETTERS) + two + [a + b for a in LETTERS for b in two]
+        PNUM_TABLES[pnum_type] = table
+    return table
+
+
+def format_text(text, w = 72, h = 40, fill = FILL_ALTERNATE, seed = 0, hyph = None):
+    """
+    Formats a string and returns the result as a string
+    """
+    tf = TextFormat(w, h, fill = fill, seed = seed, hyph = hyph)
+    lines = tf.IterLines(io.StringIO(text, newline = None))
+    return "\n".join(lines) + "\n"
+
+
+class Paginator(TextFormat):
+    """
+    Pagination-only pass
+
+    Breaks lines and closes pages like TextFormat but does not build the
+    lines or keep the output. Fill alignment only advances the fill
+    policy, footnotes are aligned because their lines are kept in the
+    state until the page is closed.
+    """
+    def __init__(self, w = 72, h = 40, fill = FILL_ALTERNATE, seed = 0, hyph = None):
+        TextFormat.__init__(self, w, h, PageCounter(), fill, seed, hyph)
+
+    def LineAlign(self, s, normal_str = True):
+        if self.align == A_FILL or not normal_str:
+            return TextFormat.LineAlign(self, s, normal_str)
+        return s
+
+    def PrintWords(self, words, i, j, lw, cw):
+        # Текст строки нужен только для поиска ссылок на сноски
+        if len(self.fn_wait) > 0:
+            TextFormat.PrintWords(self, words, i, j, lw, cw)
+            return
+        # Выравнивание по ширине меняет состояние политики заполнения
+        if self.align == A_FILL:
+            line = words[i:j + 1]
+            # Промежутки считаются без split, если в словах нет других
+            # пробельных символов
+            if "" in line or not all(map(str.isprintable, line)):
+                TextFormat.LineAlign(self, ' '.join(line), cw)
+            elif j > i:
+                sp = (cw - lw + j - i) % (j - i)
+                if sp > 0:
+                    self.FillGaps(j - i, sp)
+        self.PrintLine("")
+
+
+def paginate_part(lines, state, start = 0):
+    """
+    Continues pagination from a state
+
+    Returns a list of (index, state) pairs: index of the first line
+    after a page break, counted from start, and the formatter state
+    before that line; and the state after the last line, from which the
+    next part of the document is paginated. lines are without line
+    endings, as read_lines yields them.
+    """
+    tf = Paginator()
+    tf.SetState(state)
+    out = tf.out
+    process = tf.ProcessStripped
+    checkpoints = []
+    pages = 0
+    for i, l in enumerate(lines, start + 1):
+        process(l)
+        if out.pages != pages:
+            pages = out.pages
+            checkpoints.append((i, tf.Checkpoint()))
+    return checkpoints, tf.Checkpoint()
+
+
+def render_segment(lines, state, last):
+    """
+    Formats a part of a document starting from a checkpoint state
+
+    Returns the formatted text; the document is closed after the last
+    segment only.
+    """
+    buf = io.StringIO()
+    tf = TextFormat(out = PageWriter(buf, 0))
+    tf.SetState(state)
+    for l in lines:
+        tf.ProcessStripped(l)
+    if last:
+        tf.Flush(True)
+    else:
+        tf.out.Flush()
+    return buf.getvalue()
+
+
+class CompiledMatch():
+    """
+    Command arguments saved in a CompiledDocument
+
+    Replaces the match object of the command pattern for the handler.
+    """
+    def __init__(self, groups):
+        self.groups = groups
+
+    def group(self, i):
+        return self.groups[i - 1]
+
+
+class CompiledDocument():
+    """
+    Parsed document that can be formatted many times
+
+    ops holds a tuple for every source line: (OP_COMMAND, name, groups,
+    line) for commands, where groups are the arguments matched by the
+    command pattern or None, and (OP_TEXT, line, text, width, narrow) for
+    text lines with aliases applied, where text is the stripped line and
+    line is None if it is the same as text. TextFormat.ProcessCompiled
+    formats it without matching commands, stripping lines or measuring
+    them again.
+
+    Words are not stored separately: loading a list of words creates the
+    same strings as str.split and takes longer.
+    """
+    def __init__(self):
+        self.ops = []
+        self.version = COMPILED_VERSION
+        # Исходный файл: размер, время изменения и хэш содержимого
+        self.size = None
+        self.mtime = None
+        self.hash = None
+
+    @staticmethod
+    def Compile(lines):
+        """
+        Compiles lines without line endings
+        """
+        doc = CompiledDocument()
+        doc.ops.extend(CompiledDocument.IterOps(lines))
+        return doc
+
+    @staticmethod
+    def IterOps(lines):
+        """
+        Compiles lines without line endings and yields the operations
+        """
+        fn_lines = 0
+        aliases = {}
+        table = None
+        for line in lines:
+            # Команды распознаются так же, как в ProcessStripped
+            m = CMD_RE.match(line) if line[:1] == '?' and fn_lines == 0 else None
+            if m != None:
+                name = m.group(1)
+                groups = None
+                cmd = CMD_TABLE.get(name)
+                if cmd != None and cmd[1] != None:
+                    mm = cmd[1].match(line)
+                    if mm != None:
+                        groups = mm.groups()
+                if name == "footnote" and groups != None:
+                    fn_lines = int(groups[0])
+                elif name == "alias" and groups != None:
+                    if groups[0] != None:
+                        aliases[groups[0]] = groups[1]
+                        table = str.maketrans(aliases)
+                    else:
+                        aliases = {}
+                        table = None
+                yield OP_COMMAND, name, groups, line
+                continue
+            if table != None:
+                line = line.translate(table)
+            if FN_REF in line:
+                line = line.replace(FN_REF, "")
+            s = line.strip()
+            if fn_lines > 0 and s != "":
+                fn_lines -= 1
+            yield OP_TEXT, line if line != s else None, s, text_width(s), is_narrow(s)
+
+    def Save(self, name):
+        import pickle
+        with open(name, "wb") as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def Load(name):
+        """
+        Loads a saved CompiledDocument, returns None if it can't be read
+        """
+        import pickle
+        try:
+            with open(name, "rb") as f:
+                doc = pickle.load(f)
+            if isinstance(doc, CompiledDocument) and doc.version == COMPILED_VERSION:
+                return doc
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+        return None
+
+
+def file_digest(name):
+    """
+    Returns the blake2b hash of the file content
+    """
+    import hashlib
+    h = hashlib.blake2b()
+    with open(name, "rb") as f:
+        for block in iter(lambda: f.read(READ_CHUNK), b""):
+            h.update(block)
+    return h.digest()
+
+
+def compile_file(name, cache_dir):
+    """
+    Returns a CompiledDocument of a file, cached in cache_dir
+
+    The cached document is used if the file has the same size and
+    modification time, or the same content hash, as when it was compiled.
+    """
+    import hashlib
+    st = os.stat(name)
+    cache = os.path.join(cache_dir, hashlib.blake2b(os.path.abspath(name).encode("UTF8"),
+        digest_size = 16).hexdigest() + ".tfc")
+    doc = CompiledDocument.Load(cache)
+    if doc != None and doc.size == st.st_size and doc.mtime == st.st_mtime_ns:
+        return doc
+
+    digest = file_digest(name)
+    if doc == None or doc.hash != digest:
+        with open(name, encoding = "UTF8") as f:
+            doc = CompiledDocument.Compile(read_lines(f))
+        doc.hash = digest
+    doc.size = st.st_size
+    doc.mtime = st.st_mtime_ns
+    os.makedirs(cache_dir, exist_ok = True)
+    try:
+        doc.Save(cache)
+    except OSError as err:
+        print("Could not write file", cache, "due to", err, file = sys.stderr)
+    return doc
+
+
+class LayoutFormat(TextFormat):
+    """
+    Formatter with a fixed page size
+
+    ?size commands end the paragraph like in TextFormat but do not change
+    the page size, so one document can be formatted for several page
+    sizes.
+    """
+    def CmdSize(self, line, m = None):
+        if m != None:
+            self.Flush()
+        else:
+            self.PrintErr("Invalid size command: " + line)
+
+
+def format_layouts(lines, layouts, fill = FILL_ALTERNATE, seed = 0, hyph = None):
+    """
+    Formats a document for several page sizes in one pass
+
+    layouts is a list of (h, w, out) where out is a PageWriter. Lines are
+    compiled once, in blocks of LAYOUT_BLOCK lines, and every block is
+    formatted by a LayoutFormat of each size. Returns the formatters.
+    """
+    tfs = [LayoutFormat(w, h, out, fill, seed, hyph) for h, w, out in layouts]
+    ops = CompiledDocument.IterOps(lines)
+    while True:
+        block = list(islice(ops, LAYOUT_BLOCK))
+        if len(block) == 0:
+            break
+        for tf in tfs:
+            tf.ProcessOps(block)
+    for tf in tfs:
+        tf.Flush(True)
+    return tfs
+
+
+def parse_layout(s):
+    """
+    Parses HxW:FILE of --layouts, returns (h, w, name)
+    """
+    size, sep, name = s.partition(":")
+    h, x, w = size.lower().partition("x")
+    if sep == "" or x == "" or name == "" or not h.isdigit() or not w.isdigit():
+        raise ValueError("expected HxW:FILE, got " + s)
+    h, w = int(h), int(w)
+    if h < MIN_PAGE_SIZE[0] or w < MIN_PAGE_SIZE[1]:
+        raise ValueError("page size {}x{} is less than {}x{}".format(h, w, *MIN_PAGE_SIZE))
+    if h > MAX_PAGE_SIZE[0] or w > MAX_PAGE_SIZE[1]:
+        raise ValueError("page size {}x{} is more than {}x{}".format(h, w, *MAX_PAGE_SIZE))
+    return h, w, name
+
+
+def read_offsets(f):
+    """
+    Reads lines of a UTF-8 file opened in binary mode
+
+    Yields (offset, line) pairs, where offset is the byte position of
+    the line in the file. Line endings are handled like in read_lines.
+    """
+    offset = f.tell()
+    for raw in f:
+        n = len(raw)
+        if raw[-1:] == b"\n":
+            body = raw[:-2] if raw[-2:-1] == b"\r" else raw[:-1]
+        else:
+            body = raw[:-1] if raw[-1:] == b"\r" else raw
+        if b"\r" in body:
+            pos = offset
+            for part in body.split(b"\r"):
+                yield pos, part.decode("UTF8")
+                pos += len(part) + 1
+        else:
+            yield offset, body.decode("UTF8")
+        offset += n
+
+
+class PageIndex():
+    """
+    Formatter states at page starts of a source file
+
+    entries holds (pages, offset, state) for the start of the file and
+    every input line that follows a page break: the number of pages
+    before the line, the byte offset of the line in the file and the
+    pickled formatter state before it together with the lines of the
+    next page that were already written, such as headers. Render formats a range of pages starting
+    from the nearest entry instead of the start of the file.
+
+    The index is valid while the file has the same size and modification
+    time or the same content hash, and is built with the same fill
+    policy, seed and hyphenation patterns.
+    """
+    def __init__(self, fill = FILL_ALTERNATE, seed = 0, hyph = None):
+        self.version = PAGE_INDEX_VERSION
+        self.fill = fill
+        self.seed = seed
+        self.hyph = hyph
+        self.entries = []
+        self.size = None
+        self.mtime = None
+        self.hash = None
+
+    def Add(self, pages, offset, tf):
+        import pickle
+        state = tf.GetState()
+        # Шаблоны переносов хранятся один раз в индексе
+        state["hyph"] = None
+        self.entries.append((pages, offset,
+            pickle.dumps((state, tf.out.buf), pickle.HIGHEST_PROTOCOL)))
+
+    @staticmethod
+    def Build(name, fill = FILL_ALTERNATE, seed = 0, hyph = None):
+        """
+        Paginates a file and returns its index
+        """
+        index = PageIndex(fill, seed, hyph)
+        st = os.stat(name)
+        index.size = st.st_size
+        index.mtime = st.st_mtime_ns
+        index.hash = file_digest(name)
+        # Строки, выведенные после конца страницы, нужны выровненными,
+        # поэтому Paginator здесь не подходит
+        tf = TextFormat(out = PageTail(), fill = fill, seed = seed, hyph = hyph)
+        index.Add(0, 0, tf)
+        pages = 0
+        with open(name, "rb") as f:
+            for offset, line in read_offsets(f):
+                if tf.out.pages != pages:
+                    pages = tf.out.pages
+                    index.Add(pages, offset, tf)
+                tf.ProcessStripped(line)
+        return index
+
+    def Matches(self, name, fill = FILL_ALTERNATE, seed = 0, hyph = None):
+        """
+        Checks that the index is built for this file and parameters
+
+        Updates the saved modification time if only it has changed.
+        """
+        if (self.fill, self.seed, self.hyph) != (fill, seed, hyph):
+            return False
+        st = os.stat(name)
+        if self.size != st.st_size:
+            return False
+        if self.mtime != st.st_mtime_ns:
+            if self.hash != file_digest(name):
+                return False
+            self.mtime = st.st_mtime_ns
+        return True
+
+    def Render(self, name, first, last = None, sink = None):
+        """
+        Writes pages first ... last of the file (counted from 1) to sink
+
+        If last is None pages are written up to the end of the file.
+        """
+        import bisect
+        import pickle
+        pos = bisect.bisect_right([e[0] for e in self.entries], first - 1) - 1
+        pages, offset, state = self.entries[pos]
+        count = last - first + 1 if last != None else sys.maxsize
+        out = PageRangeWriter(sink, first - 1 - pages, count)
+        tf = TextFormat(out = out)
+        state, head = pickle.loads(state)
+        state["hyph"] = self.hyph
+        tf.SetState(state)
+        for l in head:
+            out.Write(l)
+        with open(name, encoding = "UTF8") as f:
+            f.seek(offset)
+            for l in read_lines(f):
+                tf.ProcessStripped(l)
+                if out.done:
+                    break
             else:
-                if self.fn_index == 1:
-                    self.fn.insert(0,"-"*self.fn_w)
-                    self.left -= 1   
+                tf.Flush(True)
+        out.Close()
 
-    def CmdAlias(self, line):
-        pass  
+    def Save(self, name):
+        import pickle
+        with open(name, "wb") as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
 
+    @staticmethod
+    def Load(name):
+        """
+        Loads a saved PageIndex, returns None if it can't be read
+        """
+        import pickle
+        try:
+            with open(name, "rb") as f:
+                index = pickle.load(f)
+            if isinstance(index, PageIndex) and index.version == PAGE_INDEX_VERSION:
+                return index
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+        return None
+
+
+def page_index(name, index_name, fill = FILL_ALTERNATE, seed = 0, hyph = None):
+    """
+    Returns the PageIndex of a file saved in index_name, rebuilding it if
+    the file has changed
+    """
+    index = PageIndex.Load(index_name)
+    if index != None:
+        mtime = index.mtime
+        if index.Matches(name, fill, seed, hyph):
+            if index.mtime == mtime:
+                return index
+        else:
+            index = None
+    if index == None:
+        index = PageIndex.Build(name, fill, seed, hyph)
+    try:
+        index.Save(index_name)
+    except OSError as err:
+        print("Could not write file", index_name, "due to", err, file = sys.stderr)
+    return index
+
+
+class IncrementalFormat():
+    """
+    Re-formats an edited document from saved checkpoints
+
+    Keeps hashes of the input lines, the output lines and the formatter
+    state at the first input line after every page break. Format starts
+    from the last checkpoint before the first changed line and stops at
+    the first checkpoint after the edit where the state is the same as in
+    the previous run; the rest of the previous output is reused.
+    """
+    def __init__(self, fill = FILL_ALTERNATE, seed = 0, hyph = None):
+        self.fill = fill
+        self.seed = seed
+        self.hyph = hyph
+        self.hashes = []
+        # (input line index, output line index, state)
+        self.checkpoints = []
+        self.output = []
+
+    def Format(self, lines):
+        """
+        Formats lines and returns the output text
+        """
+        import hashlib
+        hashes = [hashlib.blake2b(l.encode("UTF8"), digest_size = 8).digest()
+            for l in lines]
+        old = self.hashes
+        # Первая измененная строка и количество неизмененных строк в конце
+        d = 0
+        n = min(len(old), len(hashes))
+        while d < n and old[d] == hashes[d]:
+            d += 1
+        cs = 0
+        while cs < n - d and old[-1 - cs] == hashes[-1 - cs]:
+            cs += 1
+        delta = len(hashes) - len(old)
+
+        tf = TextFormat(out = PageCollector(None, 0), fill = self.fill, seed = self.seed,
+            hyph = self.hyph)
+        k = 0
+        while k < len(self.checkpoints) and self.checkpoints[k][0] <= d:
+            k += 1
+        if k > 0:
+            start, out_pos, state = self.checkpoints[k - 1]
+            tf.SetState(state)
+            checkpoints = self.checkpoints[:k]
+        else:
+            start, out_pos = 0, 0
+            checkpoints = [(0, 0, tf.GetState())]
+        old_checkpoints = {}
+        for cp in self.checkpoints[k:]:
+            old_checkpoints[cp[0]] = cp
+
+        output = self.output[:out_pos]
+        pages = 0
+        tail = None
+        for i in range(start, len(lines)):
+            tf.ProcessLine(lines[i])
+            if tf.out.pages == pages:
+                continue
+            pages = tf.out.pages
+            state = tf.GetState()
+            pos = out_pos + len(tf.out.buf)
+            checkpoints.append((i + 1, pos, state))
+            old_cp = old_checkpoints.get(i + 1 - delta)
+            if i + 1 >= len(lines) - cs and old_cp != None and old_cp[2] == state:
+                tail = old_cp
+                break
+
+        output += tf.out.buf
+        if tail != None:
+            shift = len(output) - tail[1]
+            output += self.output[tail[1]:]
+            for i, pos, state in self.checkpoints:
+                if i > tail[0]:
+                    checkpoints.append((i + delta, pos + shift, state))
+        else:
+            n = len(tf.out.buf)
+            tf.Flush(True)
+            output += tf.out.buf[n:]
+
+        self.hashes = hashes
+        self.checkpoints = checkpoints
+        self.output = output
+        return "\n".join(output) + "\n"
+
+    def Save(self, name):
+        import pickle
+        with open(name, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def Load(name, fill = FILL_ALTERNATE, seed = 0, hyph = None):
+        """
+        Loads a saved IncrementalFormat
+
+        Returns a new one if the file can't be read or was saved with
+        other settings.
+        """
+        import pickle
+        try:
+            with open(name, "rb") as f:
+                inc = pickle.load(f)
+            if isinstance(inc, IncrementalFormat) and inc.fill == fill \
+                    and inc.seed == seed and inc.hyph == hyph:
+                return inc
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+        return IncrementalFormat(fill, seed, hyph)
+
+
+class FormatServer():
+    """
+    Formatting service
+
+    A client sends one JSON line with the document length in bytes and
+    the page settings, {"length": N, "w": 72, "h": 40, "fill": "alternate",
+    "seed": 0}, followed by N bytes of UTF-8 text. The server sends back
+    the formatted pages as they are ready and closes the connection; a
+    bad request is answered with one line starting with "ERROR: ". w and
+    h are bounded by MIN_PAGE_SIZE and MAX_PAGE_SIZE, as in ?size.
+
+    Documents up to inline_limit bytes are formatted in the event loop
+    page by page. Larger ones are paginated part by part in the process
+    pool, and every segment is rendered there as soon as its pages are
+    known, with no more than jobs segments of one document in the pool
+    at a time. At most max_clients connections are served at
+    once, and every page waits until the client has read the previous
+    ones. A client that does not send the whole request in timeout
+    seconds is disconnected, so it cannot hold a connection slot.
+    """
+    def __init__(self, jobs = None, max_clients = 16,
+            inline_limit = SERVE_INLINE_LIMIT, max_size = SERVE_MAX_SIZE,
+            timeout = SERVE_TIMEOUT):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.pool = None
+        self.clients = None
+        self.max_clients = max_clients
+        self.inline_limit = inline_limit
+        self.max_size = max_size
+        self.timeout = timeout
+
+    async def Handle(self, reader, writer):
+        import asyncio
+        async with self.clients:
+            try:
+                try:
+                    text, length, opts = await asyncio.wait_for(
+                        self.ReadRequest(reader), self.timeout)
+                except ValueError as err:
+                    writer.write(("ERROR: " + str(err) + "\n").encode("UTF8"))
+                except asyncio.TimeoutError:
+                    writer.write(b"ERROR: Request timed out\n")
+                else:
+                    lines = list(read_lines(io.StringIO(text, newline = None)))
+                    if length <= self.inline_limit:
+                        await self.FormatInline(lines, opts, writer)
+                    else:
+                        await self.FormatPool(lines, opts, writer)
+                await writer.drain()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                writer.close()
+
+    async def ReadRequest(self, reader):
+        """
+        Reads a request
+
+        Returns the document, its length in bytes and (w, h, fill, seed),
+        raises ValueError if the request is invalid.
+        """
+        import json
+        try:
+            req = json.loads(await reader.readline())
+            length = int(req["length"])
+            w = int(req.get("w", 72))
+            h = int(req.get("h", 40))
+            fill = FILL_POLICY[req.get("fill", "alternate")]
+            seed = int(req.get("seed", 0))
+        except (ValueError, KeyError, TypeError, AttributeError) as err:
+            raise ValueError("Invalid request: " + str(err))
+        if length < 0 or length > self.max_size:
+            raise ValueError("Document length is out of bounds")
+        if h < MIN_PAGE_SIZE[0] or w < MIN_PAGE_SIZE[1]:
+            raise ValueError("Page size coudn't be less than " + str(MIN_PAGE_SIZE))
+        if h > MAX_PAGE_SIZE[0] or w > MAX_PAGE_SIZE[1]:
+            raise ValueError("Page size coudn't be more than " + str(MAX_PAGE_SIZE))
+        try:
+            text = (await reader.readexactly(length)).decode("UTF8")
+        except UnicodeDecodeError as err:
+            raise ValueError("Invalid document: " + str(err))
+        return text, length, (w, h, fill, seed)
+
+    async def FormatInline(self, lines, opts, writer):
+        import asyncio
+        w, h, fill, seed = opts
+        tf = TextFormat(w, h, fill = fill, seed = seed)
+        for page in tf.IterPages(lines):
+            writer.write(page.Text().encode("UTF8"))
+            await writer.drain()
+            # Дать другим клиентам выполниться между страницами
+            await asyncio.sleep(0)
+
+    async def FormatPool(self, lines, opts, writer):
+        import asyncio
+        w, h, fill, seed = opts
+        loop = asyncio.get_running_loop()
+        n = len(lines)
+        step = max(1, n // (self.jobs * 4))
+        # Документ размечается частями по step строк, чтобы первые
+        # сегменты форматировались, пока размечаются следующие
+        state = Paginator(w, h, fill, seed).Checkpoint()
+        start, start_state = 0, state
+        pending = []
+        for part in range(0, n, step):
+            checkpoints, state = await loop.run_in_executor(self.pool,
+                paginate_part, lines[part:part + step], state, part)
+            for i, cp in checkpoints:
+                if i - start >= step and i < n:
+                    pending.append(loop.run_in_executor(self.pool,
+                        render_segment, lines[start:i], start_state, False))
+                    start, start_state = i, cp
+            while len(pending) > 0 and (pending[0].done() or len(pending) > self.jobs):
+                writer.write((await pending.pop(0)).encode("UTF8"))
+                await writer.drain()
+        pending.append(loop.run_in_executor(self.pool, render_segment,
+            lines[start:], start_state, True))
+        for fut in pending:
+            writer.write((await fut).encode("UTF8"))
+            await writer.drain()
+
+    async def Run(self, address):
+        """
+        Serves requests on host:port or unix:path until cancelled
+        """
+        import asyncio
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        self.clients = asyncio.Semaphore(self.max_clients)
+        # Процессы запускаются заново, а не копируются fork, иначе они
+        # унаследуют сокеты клиентов и соединения не будут закрываться
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(self.jobs, ctx) as self.pool:
+            if address.startswith("unix:"):
+                server = await asyncio.start_unix_server(self.Handle, address[5:])
+            else:
+                host, _, port = address.rpartition(":")
+                server = await asyncio.start_server(self.Handle, host or None, int(port))
+            async with server:
+                await server.serve_forever()
+
+
+class LineSplitter():
+    """
+    Cuts text that comes in blocks into lines without line endings
+
+    CRLF, LF and CR end lines, a CRLF split between two blocks counts as
+    one line ending.
+    """
+    def __init__(self):
+        self.tail = ""
+        # Последний блок закончился \r, за которым может прийти \n
+        self.skip_lf = False
+
+    def Split(self, text, last = False):
+        """
+        Returns the lines completed by the next block of text
+
+        The unfinished line is kept for the next block; with last it is
+        returned too, if not empty.
+        """
+        if self.skip_lf and text[:1] == "\n":
+            text = text[1:]
+        if text != "":
+            self.skip_lf = text[-1:] == "\r"
+        text = self.tail + text
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        lines = text.split("\n")
+        self.tail = lines.pop()
+        if last and self.tail != "":
+            lines.append(self.tail)
+            self.tail = ""
+        return lines
+
+
+def read_lines(f):
+    """
+    Reads lines of a UTF-8 file without line endings
+
+    Regular files are memory-mapped and decoded in READ_CHUNK blocks with
+    CRLF, LF and CR line endings handled for the whole block at once.
+    Other files, such as pipes and terminals, are read line by line with
+    the same line endings.
+    """
+    try:
+        fd = f.fileno()
+        st = os.fstat(fd)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        fd = None
+    splitter = LineSplitter()
+    if fd == None or not stat.S_ISREG(st.st_mode):
+        for l in f:
+            yield from splitter.Split(l)
+        yield from splitter.Split("", True)
+        return
+
+    # Файл может быть уже частично прочитан, например stdin
+    pos = os.lseek(fd, 0, os.SEEK_CUR)
+    if st.st_size <= pos:
+        return
+    import codecs
+    with mmap.mmap(fd, 0, access = mmap.ACCESS_READ) as mm:
+        decoder = codecs.getincrementaldecoder("UTF8")()
+        end = len(mm)
+        while pos < end:
+            yield from splitter.Split(decoder.decode(mm[pos:pos + READ_CHUNK]))
+            pos += READ_CHUNK
+        yield from splitter.Split(decoder.decode(b"", True), True)
+
+
+def format_stream(f, tf, idle_close = None):
+    """
+    Formats a pipe or terminal as input arrives
+
+    Input is read with select and os.read, so lines that are already
+    formatted are written by tf.out (a StreamWriter) on time even while
+    the producer is silent. With idle_close the open paragraph is closed
+    after idle_close seconds without input, as if an empty line came.
+    On Windows, where select does not work with pipes, lines are read
+    one by one. The document is closed at the end of input.
+    """
+    import select
+    import codecs
+    out = tf.out
+    try:
+        fd = f.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        fd = None
+    if fd == None or sys.platform == "win32":
+        for l in read_lines(f):
+            tf.ProcessStripped(l)
+            out.Poll()
+        tf.Flush(True)
+        return
+
+    decoder = codecs.getincrementaldecoder("UTF8")()
+    splitter = LineSplitter()
+    last_input = time.monotonic()
+    while True:
+        timeout = None
+        deadline = out.Deadline()
+        if idle_close != None and len(tf.par_words) > 0:
+            idle = last_input + idle_close
+            deadline = idle if deadline == None else min(deadline, idle)
+        if deadline != None:
+            timeout = max(0, deadline - time.monotonic())
+        ready, _, _ = select.select([fd], [], [], timeout)
+        if len(ready) == 0:
+            if idle_close != None and len(tf.par_words) > 0 \
+                    and time.monotonic() - last_input >= idle_close:
+                tf.Flush()
+            out.Poll()
+            continue
+        data = os.read(fd, READ_CHUNK)
+        if data == b"":
+            break
+        last_input = time.monotonic()
+        for l in splitter.Split(decoder.decode(data)):
+            tf.ProcessStripped(l)
+        out.Poll()
+    for l in splitter.Split(decoder.decode(b"", True), True):
+        tf.ProcessStripped(l)
+    tf.Flush(True)
+
+
+def format_texts(texts, jobs = None, w = 72, h = 40, fill = FILL_ALTERNATE, seed = 0,
+        hyph = None):
+    """
+    Formats many strings in a pool of threads
+
+    Returns the results in the same order. Every text gets its own
+    TextFormat, which keeps all its state, including the fill random
+    generator, in the object; module globals are only caches of values
+    that never change, so threads do not affect each other. hyph is
+    shared, its cache is thread-safe.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers = jobs) as pool:
+        return list(pool.map(lambda text: format_text(text, w, h, fill, seed, hyph), texts))
+
+
+def format_file(inp, outp, fill = FILL_ALTERNATE, seed = 0, hyph = None):
+    """
+    Formats one file into another
+
+    Runs in a batch worker process, so errors are returned instead of
+    raised: the result is (inp, outp, error, lines, pages, seconds).
+    """
+    start = time.perf_counter()
+    lines = 0
+    try:
+        with open(inp, encoding = "UTF8") as inf, \
+                open(outp, "w", encoding = "UTF8") as outf:
+            tf = TextFormat(out = PageWriter(outf, 0), fill = fill, seed = seed,
+                hyph = hyph)
+            for l in read_lines(inf):
+                tf.ProcessStripped(l)
+                lines += 1
+            tf.Flush(True)
+    except Exception as err:
+        return inp, outp, str(err), lines, 0, time.perf_counter() - start
+    return inp, outp, None, lines, tf.out.pages, time.perf_counter() - start
+
+
+def read_manifest(name):
+    """
+    Reads a batch manifest
+
+    Every line holds an input file and optionally an output file separated
+    by a tab. Empty lines and lines starting with # are skipped.
+    """
+    files = []
+    with open(name, encoding = "UTF8") as mf:
+        for l in mf:
+            l = l.rstrip("\r\n")
+            if l.strip() == "" or l.lstrip().startswith("#"):
+                continue
+            inp, _, outp = l.partition("\t")
+            files.append((inp.strip(), outp.strip() or None))
+    return files
+
+
+def run_batch(files, out_dir = None, jobs = None, fill = FILL_ALTERNATE, seed = 0,
+        hyph = None, threads = False):
+    """
+    Formats many files in a pool of worker processes
+
+    files is a list of (input, output) pairs; if output is None the result
+    is written to <input>.out, in out_dir if it is given. With threads a
+    pool of threads is used instead, which starts faster and runs in
+    parallel on free-threaded Python builds. Prints failures and a
+    summary to stderr and returns the number of failed files. If files
+    have the same output file, nothing is formatted and they are failed.
+    """
+    tasks = []
+    outputs = {}
+    for inp, outp in files:
+        if outp == None:
+            outp = inp + ".out"
+            if out_dir != None:
+                outp = os.path.join(out_dir, os.path.basename(outp))
+        tasks.append((inp, outp))
+        # Файлы с одинаковыми именами из разных каталогов попали бы
+        # в out_dir в один и тот же файл
+        outputs.setdefault(os.path.normcase(os.path.abspath(outp)), []).append(inp)
+    clashes = 0
+    for outp, inps in outputs.items():
+        if len(inps) > 1:
+            print("Could not format", ", ".join(inps), "due to the same output file",
+                outp, file = sys.stderr)
+            clashes += len(inps)
+    if clashes > 0:
+        return clashes
+    if out_dir != None:
+        os.makedirs(out_dir, exist_ok = True)
+
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    start = time.perf_counter()
+    failed = lines = pages = 0
+    executor = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    with executor(max_workers = jobs) as pool:
+        futures = [pool.submit(format_file, inp, outp, fill, seed, hyph)
+            for inp, outp in tasks]
+        for (inp, outp), fut in zip(tasks, futures):
+            try:
+                inp, outp, err, nl, np, _ = fut.result()
+            except Exception as e:
+                err, nl, np = str(e), 0, 0
+            if err != None:
+                failed += 1
+                print("Could not format", inp, "due to", err, file = sys.stderr)
+            lines += nl
+            pages += np
+
+    print("Formatted {} of {} files: {} lines, {} pages in {:.2f} s".format(
+        len(tasks) - failed, len(tasks), lines, pages, time.perf_counter() - start),
+        file = sys.stderr)
+    return failed
 
 
 def main():
     """ Application entry point """
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", help = "File to process. If empty stdin will be used.")
+    parser.add_argument("-o", help = "File to write. If empty stdout will be used.")
+    parser.add_argument("--flush_pages", type = int, default = 1,
+        help = "Write output every N pages, 0 - at the end of document.")
+    parser.add_argument("--fill", choices = FILL_POLICY.keys(), default = "alternate",
+        help = "Gaps that get extra spaces in fill alignment.")
+    parser.add_argument("--seed", type = int, default = 0,
+        help = "Seed for --fill random, applied per page.")
+    parser.add_argument("--batch", nargs = "+", metavar = "FILE",
+        help = "Files to format in worker processes, each into <file>.out.")
+    parser.add_argument("--manifest",
+        help = "File with a list of files to format in worker processes.")
+    parser.add_argument("--out_dir", help = "Directory for --batch output files.")
+    parser.add_argument("--threads", action = "store_true",
+        help = "Format --batch files in threads instead of worker processes.")
+    parser.add_argument("--cache",
+        help = "File with checkpoints of the previous run to format only what was edited.")
+    parser.add_argument("--serve", metavar = "ADDRESS",
+        help = "Run formatting service on host:port or unix:path.")
+    parser.add_argument("--max_clients", type = int, default = 16,
+        help = "Number of connections --serve handles at once.")
+    parser.add_argument("--max_size", type = int, default = SERVE_MAX_SIZE >> 20,
+        help = "Largest document --serve accepts, in megabytes.")
+    parser.add_argument("--timeout", type = float, default = SERVE_TIMEOUT,
+        help = "Seconds a --serve client has to send its request.")
+    parser.add_argument("--compiled", metavar = "DIR",
+        help = "Keep the parsed -f file in DIR and format from it.")
+    parser.add_argument("--layouts", nargs = "+", metavar = "HxW:FILE",
+        help = "Format the document for every page size into its own file in one pass.")
+    parser.add_argument("--pages", metavar = "FIRST-LAST",
+        help = "Format only these pages of the -f file using its page index.")
+    parser.add_argument("--index", metavar = "FILE",
+        help = "Page index file for --pages, <file>.tfi by default.")
+    parser.add_argument("--stream", action = "store_true",
+        help = "Write every output line as soon as it is formatted, for live pipes.")
+    parser.add_argument("--flush_lines", type = int, default = 1,
+        help = "With --stream write output every N lines.")
+    parser.add_argument("--flush_time", type = float, default = 0.1,
+        help = "With --stream write output lines at most this many seconds late.")
+    parser.add_argument("--idle_close", type = float,
+        help = "With --stream close the paragraph after this many seconds without input.")
+    parser.add_argument("--hyphen", nargs = "+", metavar = "FILE",
+        help = "Hyphenate words with patterns from TeX pattern files.")
+    parser.add_argument("--stats", action = "store_true",
+        help = "Write formatting counters and timings as JSON to stderr.")
+    parser.add_argument("-j", "--jobs", type = int,
+        help = "Number of worker processes. Default is the number of CPUs.")
     args = parser.parse_args()
+    if args.compiled != None and args.f == None:
+        parser.error("--compiled requires -f")
+    if args.stats:
+        # Счетчики есть только у одного форматера, который пишет вывод
+        for name in ("batch", "manifest", "cache", "serve", "layouts", "pages"):
+            if getattr(args, name) != None:
+                parser.error("--stats can't be used with --" + name)
+    pages = None
+    if args.pages != None:
+        if args.f == None:
+            parser.error("--pages requires -f")
+        first, dash, last = args.pages.partition("-")
+        if not first.isdigit() or not (last.isdigit() or last == ""):
+            parser.error("--pages: expected FIRST-LAST, got " + args.pages)
+        if last != "":
+            pages = (int(first), int(last))
+        else:
+            pages = (int(first), None if dash != "" else int(first))
+        if pages[0] < 1 or (pages[1] != None and pages[1] < pages[0]):
+            parser.error("--pages: invalid range " + args.pages)
+    layouts = []
+    for l in args.layouts or []:
+        try:
+            layouts.append(parse_layout(l))
+        except ValueError as err:
+            parser.error("--layouts: " + str(err))
+
+    hyph = None
+    if args.hyphen != None:
+        from tfhyph import load_patterns
+        try:
+            hyph = load_patterns(*args.hyphen)
+        except OSError as err:
+            print("Could not open file", err.filename, "due to", err)
+            sys.exit(1)
+
+    if args.serve != None:
+        import asyncio
+        try:
+            server = FormatServer(args.jobs, args.max_clients,
+                max_size = args.max_size << 20, timeout = args.timeout)
+            asyncio.run(server.Run(args.serve))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.batch != None or args.manifest != None:
+        files = [(f, None) for f in args.batch or []]
+        if args.manifest != None:
+            try:
+                files += read_manifest(args.manifest)
+            except OSError as err:
+                print("Could not open file", args.manifest, "due to", err)
+                sys.exit(1)
+        failed = run_batch(files, args.out_dir, args.jobs,
+            FILL_POLICY[args.fill], args.seed, hyph, args.threads)
+        sys.exit(1 if failed > 0 else 0)
+
     if args.f != None:
         try: 
             inf = open(args.f, encoding = "UTF8")
@@ -791,14 +2731,76 @@ def main():
             sys.exit(1)
     else:
         inf = sys.stdin
+
+    if len(layouts) > 0:
+        outs = []
+        for h, w, name in layouts:
+            try:
+                outs.append((h, w, PageWriter(open(name, "w", encoding = "UTF8"),
+                    args.flush_pages)))
+            except OSError as err:
+                print("Could not open file", name, "due to", err)
+                sys.exit(1)
+        format_layouts(read_lines(inf), outs, FILL_POLICY[args.fill], args.seed, hyph)
+        for h, w, out in outs:
+            out.sink.close()
+        return
     
-    tf = TextFormat() 
+    if args.o != None:
+        try:
+            outf = open(args.o, "w", encoding = "UTF8")
+        except OSError as err:
+            print("Could not open file", args.o, "due to", err)
+            sys.exit(1)
+    else:
+        outf = sys.stdout
 
-    for l in inf:
-        tf.ProcessLine(l)
+    if pages != None:
+        index_name = args.index if args.index != None else args.f + ".tfi"
+        try:
+            index = page_index(args.f, index_name, FILL_POLICY[args.fill], args.seed, hyph)
+        except OSError as err:
+            print("Could not open file", args.f, "due to", err)
+            sys.exit(1)
+        index.Render(args.f, pages[0], pages[1], outf)
+        return
+
+    if args.cache != None:
+        inc = IncrementalFormat.Load(args.cache, FILL_POLICY[args.fill], args.seed, hyph)
+        outf.write(inc.Format(list(read_lines(inf))))
+        outf.flush()
+        try:
+            inc.Save(args.cache)
+        except OSError as err:
+            print("Could not write file", args.cache, "due to", err, file = sys.stderr)
+        return
+
+    if args.stream:
+        out = StreamWriter(outf, args.flush_lines, args.flush_time)
+    else:
+        out = PageWriter(outf, args.flush_pages)
+    tf = TextFormat(out = out, fill = FILL_POLICY[args.fill], seed = args.seed,
+        hyph = hyph)
+    if args.stats:
+        import json
+        tf.EnableStats().AddHook(lambda report:
+            print(json.dumps(report), file = sys.stderr))
+
+    if args.stream:
+        format_stream(inf, tf, args.idle_close)
+        return
+
+    if args.compiled != None:
+        tf.ProcessCompiled(compile_file(args.f, args.compiled))
+        tf.Flush(True)
+        return
+
+    for l in read_lines(inf):
+        tf.ProcessStripped(l)
     
-    tf.Flush()
+    tf.Flush(True)
 
 
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
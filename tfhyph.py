@@ -0,0 +1,174 @@
+# Project: Text Formatter, task from Charles Wetherell book
+#
+# https://github.com/yevgab/text_formatter.git
+#
+# dr.doberman, EnesGUL, Faf_Faf, yevgab
+#
+"""
+tfhyph finds hyphenation points of words with Liang's patterns
+
+Patterns are read from TeX pattern files, such as hyph-ru.pat.txt and
+hyph-en-us.pat.txt of the hyph-utf8 package, or from .tex files with
+\\patterns{...} and \\hyphenation{...}.
+"""
+
+import re
+from functools import lru_cache
+
+# Сколько слов запоминается с их переносами
+CACHE_SIZE = 1 << 14
+
+# Команды TeX и комментарии в файлах шаблонов
+TEX_RE = re.compile(r"%.*|\\[a-zA-Z]+|[{}]")
+
+
+class Hyphenator():
+    """
+    Hyphenation patterns stored in a trie
+
+    Every node of the trie is a dict from a letter to the next node; the
+    points of a pattern ending at a node are kept under the key None.
+    Positions of a word are memoized in an LRU cache of cache_size words.
+    left_min and right_min are the shortest parts a word is broken into.
+    """
+    def __init__(self, left_min = 2, right_min = 2, cache_size = CACHE_SIZE):
+        self.left_min = left_min
+        self.right_min = right_min
+        self.cache_size = cache_size
+        self.patterns = []
+        self.exceptions = {}
+        self.trie = {}
+        self.Positions = lru_cache(cache_size)(self.FindPositions)
+
+    def Load(self, name):
+        """
+        Adds patterns and exceptions from a file
+
+        Words with hyphens and without digits are exceptions, all other
+        words are patterns.
+        """
+        with open(name, encoding = "UTF8") as f:
+            text = f.read()
+        for item in TEX_RE.sub(" ", text).split():
+            if "-" in item and not any(c.isdigit() for c in item):
+                self.AddException(item)
+            else:
+                self.AddPattern(item)
+        self.Positions.cache_clear()
+
+    def AddPattern(self, pattern):
+        """
+        Adds a pattern like .ab1c or 2b1c
+        """
+        points = [0]
+        letters = []
+        for c in pattern:
+            if c.isdigit():
+                points[-1] = int(c)
+            else:
+                letters.append(c)
+                points.append(0)
+        node = self.trie
+        for c in letters:
+            node = node.setdefault(c, {})
+        node[None] = tuple(points)
+        self.patterns.append(pattern)
+
+    def AddException(self, word):
+        """
+        Adds a word hyphenated as given, like ta-ble
+        """
+        parts = word.lower().split("-")
+        positions = []
+        pos = 0
+        for p in parts[:-1]:
+            pos += len(p)
+            positions.append(pos)
+        self.exceptions["".join(parts)] = tuple(positions)
+
+    def FindPositions(self, word):
+        """
+        Returns positions in word where it can be hyphenated
+        """
+        n = len(word)
+        if n < self.left_min + self.right_min:
+            return ()
+        w = word.lower()
+        if w in self.exceptions:
+            return self.exceptions[w]
+        w = "." + w + "."
+        points = [0] * (len(w) + 1)
+        trie = self.trie
+        for i in range(len(w)):
+            node = trie
+            for c in w[i:]:
+                node = node.get(c)
+                if node == None:
+                    break
+                pts = node.get(None)
+                if pts != None:
+                    for k, v in enumerate(pts):
+                        if v > points[i + k]:
+                            points[i + k] = v
+        # Перенос перед буквой word[p] задается точкой перед w[p + 1]
+        return tuple(p for p in range(self.left_min, n - self.right_min + 1)
+            if points[p + 1] % 2)
+
+    def Split(self, word, room, width = len):
+        """
+        Hyphenates a word to fit into room columns
+
+        Returns the longest head of the word with a hyphen that takes no
+        more than room columns and the rest of the word, or None. Only
+        letters are hyphenated, punctuation around them stays attached.
+        """
+        start = 0
+        end = len(word)
+        while start < end and not word[start].isalpha():
+            start += 1
+        while end > start and not word[end - 1].isalpha():
+            end -= 1
+        core = word[start:end]
+        if not core.isalpha():
+            return None
+        for p in reversed(self.Positions(core)):
+            head = word[:start + p] + "-"
+            if width(head) <= room:
+                return head, word[start + p:]
+        return None
+
+    def __eq__(self, other):
+        return (isinstance(other, Hyphenator)
+            and self.patterns == other.patterns
+            and self.exceptions == other.exceptions
+            and (self.left_min, self.right_min) == (other.left_min, other.right_min))
+
+    def __deepcopy__(self, memo):
+        # Шаблоны не меняются при форматировании, копии состояния
+        # TextFormat используют один объект
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["trie"]
+        del state["Positions"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        patterns = self.patterns
+        self.patterns = []
+        self.trie = {}
+        for p in patterns:
+            self.AddPattern(p)
+        self.Positions = lru_cache(self.cache_size)(self.FindPositions)
+
+
+def load_patterns(*names, left_min = 2, right_min = 2):
+    """
+    Creates a Hyphenator with patterns from files
+    """
+    hyph = Hyphenator(left_min, right_min)
+    for name in names:
+        hyph.Load(name)
+    return hyph